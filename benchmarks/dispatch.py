@@ -0,0 +1,108 @@
+"""Micro-benchmark of flastapi's per-request dispatch overhead.
+
+Compares a raw Flask view that hand-parses its query string against the
+equivalent flastapi endpoint, both driven straight through the WSGI callable
+so the test client's own overhead doesn't drown out the difference.
+
+    python benchmarks/dispatch.py [--number N]
+"""
+import argparse
+import timeit
+
+from flask import Flask, request, jsonify
+from werkzeug.test import EnvironBuilder
+
+from flastapi import FlastAPI, Router, Depends
+
+QUERY = {
+    "page": "2",
+    "per_page": "50",
+    "owner": "someone",
+    "status": "open",
+    "min_score": "1.5",
+    "max_score": "9.5",
+    "tag": "perf",
+    "sort": "created",
+}
+
+
+def get_settings():
+    return {"tz": "UTC"}
+
+
+def make_raw_app():
+    app = Flask(__name__)
+
+    @app.route("/items")
+    def items():
+        args = request.args
+        page = int(args.get("page", 1))
+        per_page = int(args.get("per_page", 20))
+        owner = args["owner"]
+        status = args.get("status", "all")
+        min_score = float(args.get("min_score", 0.0))
+        max_score = float(args.get("max_score", 10.0))
+        tag = args.get("tag", "")
+        sort = args.get("sort", "id")
+        settings = get_settings()
+        return jsonify({"page": page, "settings": settings})
+
+    return app
+
+
+def make_flastapi_app():
+    app = Flask(__name__)
+    flastapi = FlastAPI(app)
+    router = Router("bench")
+
+    @router.get("/items")
+    def items(
+        owner: str,
+        page: int = 1,
+        per_page: int = 20,
+        status: str = "all",
+        min_score: float = 0.0,
+        max_score: float = 10.0,
+        tag: str = "",
+        sort: str = "id",
+        settings: dict = Depends(get_settings),
+    ):
+        return {"page": page, "settings": settings}
+
+    flastapi.add_router(router)
+    return app
+
+
+def make_environ():
+    return EnvironBuilder(path="/items", query_string=QUERY).get_environ()
+
+
+def time_wsgi(app, number):
+    environ = make_environ()
+
+    def start_response(status, headers, exc_info=None):
+        assert status.startswith("200"), status
+
+    def call():
+        for chunk in app(dict(environ), start_response):
+            pass
+
+    call()
+    return min(timeit.repeat(call, number=number, repeat=5)) / number
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--number", type=int, default=5000)
+    args = parser.parse_args()
+
+    raw = time_wsgi(make_raw_app(), args.number)
+    flastapi = time_wsgi(make_flastapi_app(), args.number)
+
+    print(f"raw flask      {raw * 1e6:8.2f} us/request")
+    print(f"flastapi       {flastapi * 1e6:8.2f} us/request")
+    print(f"overhead       {(flastapi - raw) * 1e6:8.2f} us/request")
+
+
+if __name__ == "__main__":
+    main()
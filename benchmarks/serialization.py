@@ -0,0 +1,92 @@
+"""Benchmark of response serialization for large lists of pydantic models.
+
+Compares the old `to_dict` + `jsonify` path with flastapi's codecs, in time
+and peak memory.
+
+    python benchmarks/serialization.py [--items N]
+"""
+import argparse
+import timeit
+import tracemalloc
+from typing import List
+
+from flask import Flask, jsonify
+from pydantic import BaseModel
+
+from flastapi.encoding import CODECS, compile_response_model
+
+
+class Tag(BaseModel):
+    name: str
+    weight: float
+
+
+class Item(BaseModel):
+    id: int
+    name: str
+    price: float
+    tags: List[Tag]
+
+
+def to_dict(payload):
+    # The serialization path flastapi used before it had its own encoder.
+    if isinstance(payload, dict):
+        for name, value in payload.items():
+            payload[name] = to_dict(value)
+    if isinstance(payload, (set, tuple, list)):
+        payload = [to_dict(p) for p in payload]
+    if isinstance(payload, BaseModel):
+        payload = payload.dict()
+    return payload
+
+
+def make_items(count):
+    return [
+        Item(
+            id=i,
+            name=f"item {i}",
+            price=i * 1.5,
+            tags=[Tag(name="a", weight=1.0), Tag(name="b", weight=2.0)],
+        )
+        for i in range(count)
+    ]
+
+
+def measure(func, number):
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    elapsed = min(timeit.repeat(func, number=number, repeat=3)) / number
+    return elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--items", type=int, default=5000)
+    parser.add_argument("--number", type=int, default=10)
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    items = make_items(args.items)
+    validate = compile_response_model(List[Item])
+
+    def legacy():
+        return jsonify(to_dict(items)).get_data()
+
+    candidates = [("to_dict+jsonify", legacy)]
+    for name, codec_class in CODECS.items():
+        try:
+            codec = codec_class()
+        except ImportError:
+            continue
+        candidates.append((name, lambda codec=codec: codec.dumps(validate(items))))
+
+    with app.app_context():
+        for name, func in candidates:
+            elapsed, peak = measure(func, args.number)
+            print(f"{name:16} {elapsed * 1e3:8.2f} ms  peak {peak / 2**20:7.2f} MiB")
+
+
+if __name__ == "__main__":
+    main()
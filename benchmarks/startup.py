@@ -0,0 +1,76 @@
+"""Benchmark of route registration for large route tables.
+
+Registers a few thousand endpoints, each with path and query parameters and
+a small dependency tree, with eager and with lazy route compilation. Times
+the route decorators (flastapi's own share), registering the blueprint with
+Flask (werkzeug compiles every rule there), and compiling every route's plan
+afterwards, as a warm-up would.
+
+    python benchmarks/startup.py [--routes N]
+"""
+import argparse
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from flask import Flask
+
+from flastapi import FlastAPI, Router, Depends
+
+
+def get_settings():
+    return {"tz": "UTC"}
+
+
+def get_session(settings: dict = Depends(get_settings)):
+    yield object()
+
+
+def register_routes(router, routes):
+    for index in range(routes):
+        def view(
+            item_id: int,
+            page: int = 1,
+            per_page: int = 20,
+            owner: str = "",
+            session=Depends(get_session),
+        ):
+            return {}
+
+        view.__name__ = f"view_{index}"
+        router.get(f"/items_{index}/<int:item_id>")(view)
+
+
+def time_startup(routes, lazy):
+    app = Flask(__name__)
+    flastapi = FlastAPI(app)
+    router = Router("bench", lazy=lazy)
+
+    started = time.perf_counter()
+    register_routes(router, routes)
+    decorated = time.perf_counter()
+    flastapi.add_router(router)
+    registered = time.perf_counter()
+    router.compile(flastapi)
+    compiled = time.perf_counter()
+    return decorated - started, registered - decorated, compiled - registered
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--routes", type=int, default=4000)
+    args = parser.parse_args()
+
+    # Every run gets a fresh interpreter, so one doesn't pay for the garbage
+    # of the other.
+    context = multiprocessing.get_context("spawn")
+    print(f"{'':6} {'decorators':>12} {'flask':>12} {'warm-up':>12}")
+    for lazy in (False, True):
+        with ProcessPoolExecutor(1, mp_context=context) as executor:
+            timings = executor.submit(time_startup, args.routes, lazy).result()
+        name = "lazy" if lazy else "eager"
+        print(f"{name:6}", *(f"{timing * 1e3:9.1f} ms" for timing in timings))
+
+
+if __name__ == "__main__":
+    main()
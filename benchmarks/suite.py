@@ -0,0 +1,283 @@
+"""Dispatch overhead benchmark suite, one scenario per parameter shape.
+
+Every scenario is driven straight through the WSGI callable and through the
+Flask test client, and reports the time and memory allocated per request.
+Raw Flask is the reference every other scenario's overhead is measured
+against. Results can be stored as a baseline, and later runs compared to it:
+anything slower or allocating more than the tolerance allows is flagged, and
+the run exits with a non-zero status.
+
+    python benchmarks/suite.py [--number N] [--only NAME ...]
+    python benchmarks/suite.py --save baseline.json
+    python benchmarks/suite.py --compare baseline.json [--tolerance 0.1]
+"""
+import argparse
+import io
+import json
+import sys
+import timeit
+import tracemalloc
+from typing import List
+
+from flask import Flask, request, jsonify
+from pydantic import BaseModel
+from werkzeug.test import EnvironBuilder
+
+from flastapi import FlastAPI, Router, Depends
+
+QUERY = {
+    "page": "2",
+    "per_page": "50",
+    "owner": "someone",
+    "status": "open",
+    "min_score": "1.5",
+    "max_score": "9.5",
+}
+
+
+class Item(BaseModel):
+    name: str
+    price: float
+    tags: List[str] = []
+
+
+class Owner(BaseModel):
+    name: str
+    email: str
+
+
+class Filters(BaseModel):
+    owner: str
+    page: int = 1
+    per_page: int = 20
+    status: str = "all"
+    min_score: float = 0.0
+    max_score: float = 10.0
+
+
+def get_settings():
+    return {"tz": "UTC"}
+
+
+def get_connection(settings: dict = Depends(get_settings)):
+    return {"settings": settings}
+
+
+def get_session(connection: dict = Depends(get_connection)):
+    return {"connection": connection}
+
+
+def get_transaction():
+    transaction = {"open": True}
+    yield transaction
+    transaction["open"] = False
+
+
+ITEM = {"name": "widget", "price": 9.5, "tags": ["a", "b"]}
+OWNER = {"name": "someone", "email": "someone@example.com"}
+ROWS = [
+    {"id": index, "name": f"item {index}", "price": index / 2, "tags": ["a"]}
+    for index in range(1000)
+]
+
+
+def make_raw_app():
+    app = Flask(__name__)
+
+    @app.route("/items")
+    def items():
+        args = request.args
+        page = int(args.get("page", 1))
+        per_page = int(args.get("per_page", 20))
+        owner = args["owner"]
+        status = args.get("status", "all")
+        min_score = float(args.get("min_score", 0.0))
+        max_score = float(args.get("max_score", 10.0))
+        return jsonify({"page": page, "owner": owner})
+
+    return app
+
+
+def make_flastapi_app():
+    app = Flask(__name__)
+    flastapi = FlastAPI(app)
+    router = Router("bench")
+
+    @router.get("/query")
+    def query(
+        owner: str,
+        page: int = 1,
+        per_page: int = 20,
+        status: str = "all",
+        min_score: float = 0.0,
+        max_score: float = 10.0,
+    ):
+        return {"page": page, "owner": owner}
+
+    @router.post("/body")
+    def body(item: Item):
+        return {"name": item.name}
+
+    @router.post("/multi_body")
+    def multi_body(item: Item, owner: Owner):
+        return {"name": item.name, "owner": owner.name}
+
+    @router.get("/query_model")
+    def query_model(filters: Filters = Depends(Filters)):
+        return {"page": filters.page, "owner": filters.owner}
+
+    @router.get("/nested")
+    def nested(session: dict = Depends(get_session)):
+        return session
+
+    @router.get("/context")
+    def context(transaction: dict = Depends(get_transaction)):
+        return {"open": transaction["open"]}
+
+    @router.get("/large_list")
+    def large_list():
+        return ROWS
+
+    flastapi.add_router(router)
+    return app
+
+
+# name: (app factory, request arguments, expected status)
+SCENARIOS = {
+    "raw_flask": (make_raw_app, {"path": "/items", "query_string": QUERY}, 200),
+    "query": (make_flastapi_app, {"path": "/query", "query_string": QUERY}, 200),
+    "body": (make_flastapi_app, {"path": "/body", "method": "POST", "json": ITEM}, 200),
+    "multi_body": (
+        make_flastapi_app,
+        {"path": "/multi_body", "method": "POST", "json": {"item": ITEM, "owner": OWNER}},
+        200,
+    ),
+    "query_model": (make_flastapi_app, {"path": "/query_model", "query_string": QUERY}, 200),
+    "nested_dependencies": (make_flastapi_app, {"path": "/nested"}, 200),
+    "context_dependency": (make_flastapi_app, {"path": "/context"}, 200),
+    "validation_failure": (
+        make_flastapi_app,
+        {"path": "/query", "query_string": {"page": "two", "min_score": "low"}},
+        400,
+    ),
+    "large_list": (make_flastapi_app, {"path": "/large_list"}, 200),
+}
+
+
+def make_wsgi_call(app, arguments, expected):
+    environ = EnvironBuilder(**arguments).get_environ()
+    body = environ["wsgi.input"].read()
+    expected = str(expected)
+
+    def start_response(status, headers, exc_info=None):
+        assert status.startswith(expected), status
+
+    def call():
+        copy = dict(environ)
+        copy["wsgi.input"] = io.BytesIO(body)
+        for chunk in app(copy, start_response):
+            pass
+    return call
+
+
+def make_client_call(app, arguments, expected):
+    client = app.test_client()
+
+    def call():
+        response = client.open(**arguments)
+        assert response.status_code == expected, response.status
+    return call
+
+
+def time_call(call, number):
+    call()
+    return min(timeit.repeat(call, number=number, repeat=5)) / number
+
+
+def measure_allocations(call, number=50):
+    # Bytes allocated per request, peak memory during a request included.
+    call()
+    tracemalloc.start()
+    try:
+        total = 0
+        for _ in range(number):
+            before, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            call()
+            _, peak = tracemalloc.get_traced_memory()
+            total += peak - before
+    finally:
+        tracemalloc.stop()
+    return total / number
+
+
+def run_scenario(name, number):
+    make_app, arguments, expected = SCENARIOS[name]
+    app = make_app()
+    wsgi = make_wsgi_call(app, arguments, expected)
+    client = make_client_call(app, arguments, expected)
+    return {
+        "wsgi": time_call(wsgi, number),
+        "client": time_call(client, max(number // 5, 1)),
+        "allocated": measure_allocations(wsgi),
+    }
+
+
+def compare(results, baseline, tolerance):
+    # Yields (scenario, metric, baseline, current) for every regression.
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        for metric, value in result.items():
+            previous = baseline[name].get(metric)
+            if previous and value > previous * (1 + tolerance):
+                yield name, metric, previous, value
+
+
+def format_metric(metric, value):
+    if metric == "allocated":
+        return f"{value / 1024:8.1f} KiB"
+    return f"{value * 1e6:8.2f} us"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--number", type=int, default=2000)
+    parser.add_argument("--only", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument("--save", metavar="PATH", help="store the results as baseline")
+    parser.add_argument("--compare", metavar="PATH", help="compare against a baseline")
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    args = parser.parse_args()
+
+    results = {}
+    raw = run_scenario("raw_flask", args.number)
+    print(f"{'':20} {'wsgi':>11} {'overhead':>11} {'client':>11} {'allocated':>12}")
+    for name in args.only:
+        result = raw if name == "raw_flask" else run_scenario(name, args.number)
+        results[name] = result
+        overhead = result["wsgi"] - raw["wsgi"]
+        print(
+            f"{name:20} {result['wsgi'] * 1e6:8.2f} us {overhead * 1e6:8.2f} us "
+            f"{result['client'] * 1e6:8.2f} us {result['allocated'] / 1024:8.1f} KiB"
+        )
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = list(compare(results, baseline, args.tolerance))
+        for name, metric, previous, value in regressions:
+            print(
+                f"REGRESSION {name} {metric}: {format_metric(metric, previous)}"
+                f" -> {format_metric(metric, value)}"
+            )
+        if regressions:
+            sys.exit(1)
+        print(f"no regressions beyond {args.tolerance:.0%}")
+
+
+if __name__ == "__main__":
+    main()
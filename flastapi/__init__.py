@@ -1,24 +1,201 @@
-from .routing import Router
-from .signature import Depends
+import atexit
+import gc
+from concurrent.futures import ThreadPoolExecutor
+
+from .batch import BatchRouter
+from .caching import CachePolicy, CacheBackend, MemoryCache
+from .concurrency import close_event_loops
+from .encoding import get_codec
+from .metrics import DEFAULT_BUCKETS, RequestMetrics, serve_metrics
+from .openapi import OpenAPIRouter, build_openapi
+from .pooling import PoolTimeout, ResourcePool
+from .profiling import DependencyProfiler, RequestProfiler, serve_profiles
+from .routing import Router, teardown_contexts
+from .signature import (
+    Depends,
+    DependencyOverrides,
+    Pooled,
+    Query,
+    ScopedDependencies,
+    register_converter,
+)
 
 
 class FlastAPI:
-    def __init__(self, app=None):
+    def __init__(
+        self, app=None, max_workers=None, profile_dependencies=False,
+        codec="auto", max_body_items=None, max_body_item_size=None,
+        max_errors=None, fail_fast=False
+    ):
         self.app = None
+        self._version = 0
+        self._codec = get_codec(codec)
+        self.max_workers = max_workers
+        self.max_body_items = max_body_items
+        self.max_body_item_size = max_body_item_size
+        self.max_errors = max_errors
+        self.fail_fast = fail_fast
+        self.executor = None
+        self.routers = []
         self.deferred_routers = []
-        self.dependency_overrides = {}
+        self._dependency_overrides = DependencyOverrides()
+        self.scopes = ScopedDependencies()
+        self.dependency_profiler = None
+        self.batch_router = None
+        self.openapi_router = None
+        self.metrics_router = None
+        self.profiles_router = None
+        self.request_profiler = None
+        self._metrics = None
+        if profile_dependencies:
+            self.dependency_profiler = DependencyProfiler()
         if app:
             self.init_app(app)
 
+    @property
+    def dependency_overrides(self):
+        return self._dependency_overrides
+
+    @dependency_overrides.setter
+    def dependency_overrides(self, overrides):
+        # Keep the same mapping around, compiled plans track its version.
+        self._dependency_overrides.clear()
+        self._dependency_overrides.update(overrides)
+
+    @property
+    def version(self):
+        # Compiled plans are rebuilt whenever this changes. Both counters
+        # only go up, so their sum does too.
+        return self._dependency_overrides.version + self._version
+
+    @property
+    def codec(self):
+        return self._codec
+
+    @codec.setter
+    def codec(self, codec):
+        self._codec = get_codec(codec)
+        self._version += 1
+
+    @property
+    def metrics(self):
+        return self._metrics
+
+    @metrics.setter
+    def metrics(self, metrics):
+        # Plans are only timed while metrics are on.
+        self._metrics = metrics
+        self._version += 1
+
+    def enable_metrics(self, path=None, buckets=DEFAULT_BUCKETS, callback=None):
+        # `callback(endpoint, timings)` is called after every request, with
+        # the seconds spent in each phase. A path serves the histograms in
+        # Prometheus' text format.
+        if self.metrics is None:
+            self.metrics = RequestMetrics(buckets, callback)
+        if path is not None and self.metrics_router is None:
+            self.metrics_router = Router("flastapi_metrics")
+            self.metrics_router.bp.add_url_rule(path, "metrics", serve_metrics)
+            self.add_router(self.metrics_router)
+        return self.metrics
+
+    def profile_requests(
+        self, sample_rate=0.0, header="X-Flastapi-Profile", secret=None,
+        memory=False, path=None
+    ):
+        # Profiles a sampled share of requests, and those carrying `header`
+        # set to `secret`. A path serves the aggregated reports, behind the
+        # same header, so it needs a secret.
+        if path is not None and not secret:
+            raise ValueError("Serving request profiles requires a secret")
+        self.request_profiler = RequestProfiler(sample_rate, header, secret, memory)
+        if path is not None and self.profiles_router is None:
+            self.profiles_router = Router("flastapi_profiles")
+            self.profiles_router.bp.add_url_rule(path, "profiles", serve_profiles)
+            self.add_router(self.profiles_router)
+        return self.request_profiler
+
+    def profile_dependencies(self, enabled=True):
+        if enabled and self.dependency_profiler is None:
+            self.dependency_profiler = DependencyProfiler()
+        elif not enabled:
+            self.dependency_profiler = None
+        self._version += 1
+        return self.dependency_profiler
+
+    def describe(self):
+        return [
+            description
+            for router in self.routers
+            for description in router.describe(self)
+        ]
+
+    def warmup(self):
+        # Builds every route's handler and plan, and werkzeug's url matcher,
+        # so none of it is left to the first request of every worker.
+        for router in self.routers:
+            router.compile(self)
+        if self.app is not None:
+            self.app.url_map.update()
+
+    def freeze(self):
+        # Call last thing before forking workers. Everything alive is moved
+        # to the permanent generation, the garbage collector of a worker won't
+        # touch (and copy) those pages anymore.
+        self.warmup()
+        gc.collect()
+        gc.freeze()
+
+    def enable_openapi(self, path="/openapi.json", title=None, version="0.1.0"):
+        if self.openapi_router is None:
+            self.openapi_router = OpenAPIRouter(self, path, title, version)
+            self.add_router(self.openapi_router)
+        return self.openapi_router
+
+    def openapi(self, title=None, version="0.1.0"):
+        return build_openapi(self, title, version)
+
+    def enable_batch(
+        self, path="/batch", parallel=False, max_operations=100,
+        max_workers=None
+    ):
+        if self.batch_router is None:
+            self.batch_router = BatchRouter(
+                self, path, parallel, max_operations, max_workers
+            )
+            self.add_router(self.batch_router)
+        return self.batch_router
+
     def init_app(self, app):
         self.app = app
         if not hasattr(app, "extensions"):
             app.extensions = {}
         app.extensions["flastapi"] = self
+        app.teardown_request(teardown_contexts)
+        atexit.register(self.close)
         for router in self.deferred_routers:
             self._add_router(router)
 
+    def get_executor(self):
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(
+                self.max_workers, thread_name_prefix="flastapi"
+            )
+        return self.executor
+
+    def close(self):
+        # Tears down app and thread scoped dependencies, last opened first,
+        # and the event loops of async endpoints.
+        self.scopes.close()
+        if self.batch_router is not None:
+            self.batch_router.close()
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        close_event_loops()
+
     def add_router(self, router):
+        self.routers.append(router)
         if self.app is None:
             self.deferred_routers.append(router)
         else:
@@ -0,0 +1,146 @@
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List
+
+from flask import current_app, g, request
+from pydantic import BaseModel
+from werkzeug.datastructures import Headers
+from werkzeug.exceptions import InternalServerError
+from werkzeug.test import EnvironBuilder
+
+from .routing import Router
+
+# Describe the body of the sub-request, not the one of the batch.
+SKIPPED_HEADERS = ("Content-Type", "Content-Length")
+
+
+class BatchOperation(BaseModel):
+    method: str = "GET"
+    path: str
+    query: Dict[str, Any] = {}
+    body: Any = None
+
+
+def read_body(response, codec):
+    data = response.get_data()
+    if not data:
+        return None
+    if response.is_json:
+        return codec.loads(data)
+    return data.decode()
+
+
+class BatchRouter(Router):
+    def __init__(
+        self, flastapi, path="/batch", parallel=False, max_operations=100,
+        max_workers=None
+    ):
+        super().__init__("flastapi_batch")
+        self.flastapi = flastapi
+        self.path = path
+        self.parallel_operations = parallel
+        self.max_operations = max_operations
+        self.max_workers = max_workers
+        self.executor = None
+        self.post(path)(self.handle_batch)
+
+    def handle_batch(self, operations: List[BatchOperation]):
+        max_operations = self.max_operations
+        if max_operations is not None and len(operations) > max_operations:
+            return [{
+                "loc": ["operations"],
+                "msg": f"ensure this value has at most {max_operations} items",
+                "type": "value_error.list.max_items",
+            }], 400
+
+        app = current_app._get_current_object()
+        environs = [self.make_environ(operation) for operation in operations]
+        # Only routes served by the other routers can be batched, which also
+        # rules out batches nested in a batch.
+        blueprints = {
+            router.bp.name for router in self.flastapi.routers
+            if router is not self
+        }
+
+        if self.parallel_operations:
+            executor = self.get_executor()
+            futures = [
+                executor.submit(self.run_isolated, app, environ, blueprints)
+                for environ in environs
+            ]
+            return [future.result() for future in futures]
+
+        # Sequential sub-requests run in the app context of the batch, so
+        # they share its request scoped dependencies.
+        g.batch = True
+        try:
+            return [
+                self.run_operation(app, environ, blueprints)
+                for environ in environs
+            ]
+        finally:
+            g.batch = False
+
+    def make_environ(self, operation):
+        headers = Headers([
+            (key, value) for key, value in request.headers
+            if key not in SKIPPED_HEADERS
+        ])
+        builder = EnvironBuilder(
+            path=operation.path,
+            base_url=request.url_root,
+            method=operation.method.upper(),
+            query_string=operation.query,
+            headers=headers,
+            json=operation.body,
+            environ_base={"REMOTE_ADDR": request.remote_addr},
+        )
+        try:
+            return builder.get_environ()
+        finally:
+            builder.close()
+
+    def run_operation(self, app, environ, blueprints):
+        with app.request_context(environ):
+            routing_exception = request.routing_exception
+            if routing_exception is not None:
+                return {"status": routing_exception.code, "body": None}
+            if request.blueprint not in blueprints:
+                return {"status": 404, "body": None}
+            try:
+                response = app.full_dispatch_request()
+            except Exception as e:
+                # A failing operation is answered on its own, the others
+                # still run.
+                response = self.handle_exception(app, e)
+            return {
+                "status": response.status_code,
+                "body": read_body(response, self.flastapi.codec),
+            }
+
+    def handle_exception(self, app, error):
+        try:
+            return app.handle_exception(error)
+        except Exception:
+            # Errors are re-raised when they propagate, in debug and testing
+            # mode, a batch still answers with a 500 for the operation.
+            app.log_exception(sys.exc_info())
+            return InternalServerError(original_exception=error).get_response()
+
+    def run_isolated(self, app, environ, blueprints):
+        # Parallel sub-requests each get their own app context, so a
+        # request scoped dependency is never shared between threads.
+        with app.app_context():
+            return self.run_operation(app, environ, blueprints)
+
+    def get_executor(self):
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(
+                self.max_workers, thread_name_prefix="flastapi-batch"
+            )
+        return self.executor
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
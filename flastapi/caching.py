@@ -0,0 +1,116 @@
+import hashlib
+import re
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from .encoding import JSONCodec
+
+CachedResponse = namedtuple("CachedResponse", "body status mimetype etag")
+
+# Keys only need to be stable, not fast to read back.
+KEY_CODEC = JSONCodec()
+PUBLIC_OR_PRIVATE = re.compile(r"\b(public|private)\b", re.IGNORECASE)
+
+
+def is_personal(request):
+    return "Authorization" in request.headers or "Cookie" in request.headers
+
+
+class CacheBackend:
+    # Anything that can store entries by key, with an optional ttl in
+    # seconds, can back a CachePolicy.
+    def get(self, key):
+        raise NotImplementedError
+
+    def set(self, key, entry, ttl=None):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+
+class MemoryCache(CacheBackend):
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        with self.lock:
+            item = self.entries.get(key)
+            if item is None:
+                return None
+            entry, expires = item
+            if expires is not None and expires <= time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry
+
+    def set(self, key, entry, ttl=None):
+        expires = None if ttl is None else time.monotonic() + ttl
+        with self.lock:
+            self.entries[key] = (entry, expires)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class CachePolicy:
+    def __init__(
+        self, ttl=None, max_entries=1024, vary=(), backend=None,
+        cache_control=None, ignore=()
+    ):
+        # `vary` holds header names, or callables that take the request and
+        # return something JSON serializable. `ignore` names the arguments
+        # of the view that are left out of the key, e.g. a database session.
+        self.ttl = ttl
+        self.ignore = frozenset(ignore)
+        self.vary = tuple(vary)
+        self.vary_headers = [key for key in self.vary if isinstance(key, str)]
+        self.backend = MemoryCache(max_entries) if backend is None else backend
+        if cache_control is None:
+            cache_control = "no-cache" if ttl is None else f"max-age={ttl}"
+        self.cache_control = cache_control
+
+    def make_key(self, endpoint, values, request):
+        varies = [
+            request.headers.get(key) if isinstance(key, str) else key(request)
+            for key in self.vary
+        ]
+        return KEY_CODEC.dumps([endpoint, values, varies])
+
+    def get(self, key):
+        return self.backend.get(key)
+
+    def store(self, key, response):
+        body = response.get_data()
+        etag = hashlib.sha1(body).hexdigest()
+        entry = CachedResponse(body, response.status_code, response.mimetype, etag)
+        self.backend.set(key, entry, self.ttl)
+        return entry
+
+    def respond(self, entry, request, response_class):
+        if request.if_none_match.contains(entry.etag):
+            response = response_class(status=304)
+        else:
+            response = response_class(
+                entry.body, entry.status, mimetype=entry.mimetype
+            )
+        response.set_etag(entry.etag)
+        cache_control = self.cache_control
+        if is_personal(request) and not PUBLIC_OR_PRIVATE.search(cache_control):
+            # Keyed on whoever asked, shared caches must not hand it out.
+            cache_control = "private, " + cache_control
+        response.headers["Cache-Control"] = cache_control
+        if self.vary_headers:
+            response.vary.update(self.vary_headers)
+        return response
@@ -0,0 +1,73 @@
+import asyncio
+import inspect
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+_local = threading.local()
+_loops = set()
+_loops_lock = threading.Lock()
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_event_loop():
+    # Every worker thread gets its own loop, created on first use and reused
+    # for every request that thread handles afterwards.
+    loop = getattr(_local, "loop", None)
+    if loop is None or loop.is_closed():
+        loop = _local.loop = asyncio.new_event_loop()
+        with _loops_lock:
+            _loops.add(loop)
+    return loop
+
+
+def run(coroutine):
+    return get_event_loop().run_until_complete(coroutine)
+
+
+def close_event_loops():
+    # The loops of every thread, once they're done serving. A loop that is
+    # still running is left alone.
+    with _loops_lock:
+        loops = [loop for loop in _loops if not loop.is_running()]
+        _loops.difference_update(loops)
+    for loop in loops:
+        if not loop.is_closed():
+            loop.run_until_complete(loop.shutdown_asyncgens())
+            loop.close()
+
+
+def is_async(func):
+    return inspect.iscoroutinefunction(func) or inspect.isasyncgenfunction(func)
+
+
+def finalize(context, error=None):
+    # Runs the code after a context dependency's `yield`. An error is thrown
+    # in at the `yield`, so `with` blocks and `except` clauses see it. The
+    # context re-raising that same error is fine, it's handled elsewhere.
+    try:
+        if inspect.isasyncgen(context):
+            if error is None:
+                run(context.__anext__())
+            else:
+                run(context.athrow(error))
+        elif error is None:
+            next(context)
+        else:
+            context.throw(error)
+    except (StopIteration, StopAsyncIteration):
+        pass
+    except BaseException as e:
+        if e is not error:
+            raise
+
+
+def get_executor():
+    # Shared, bounded pool for parallel dependency resolution when no
+    # FlastAPI instance provides its own.
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(thread_name_prefix="flastapi")
+    return _executor
@@ -0,0 +1,196 @@
+import json
+import typing
+from collections.abc import AsyncIterator, Iterable, Iterator, Sequence
+
+from pydantic import BaseModel, parse_obj_as
+from pydantic.json import pydantic_encoder
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:  # pragma: no cover
+    msgspec = None
+
+
+def default(obj):
+    # A model's own __dict__ holds exactly its fields, so handing it to the
+    # encoder serializes the model in place, without building a dict tree.
+    if isinstance(obj, BaseModel):
+        return obj.__dict__
+    return pydantic_encoder(obj)
+
+
+class JSONCodec:
+    name = "json"
+
+    def __init__(self):
+        self.encoder = json.JSONEncoder(
+            default=default, ensure_ascii=False, separators=(",", ":")
+        )
+
+    def dumps(self, payload):
+        return self.encoder.encode(payload).encode("utf-8")
+
+    def loads(self, data):
+        return json.loads(data)
+
+
+class OrjsonCodec(JSONCodec):
+    name = "orjson"
+
+    def __init__(self):
+        if orjson is None:
+            raise ImportError("The orjson codec requires orjson to be installed")
+        self.option = orjson.OPT_NON_STR_KEYS
+
+    def dumps(self, payload):
+        return orjson.dumps(payload, default=default, option=self.option)
+
+    def loads(self, data):
+        return orjson.loads(data)
+
+
+class MsgspecCodec(JSONCodec):
+    name = "msgspec"
+
+    def __init__(self):
+        if msgspec is None:
+            raise ImportError("The msgspec codec requires msgspec to be installed")
+        self.encoder = msgspec.json.Encoder(
+            enc_hook=default, decimal_format="number"
+        )
+        self.decoder = msgspec.json.Decoder()
+
+    def dumps(self, payload):
+        return self.encoder.encode(payload)
+
+    def loads(self, data):
+        try:
+            return self.decoder.decode(data)
+        except msgspec.DecodeError as e:
+            raise ValueError(str(e)) from e
+
+
+CODECS = {
+    codec.name: codec for codec in (JSONCodec, OrjsonCodec, MsgspecCodec)
+}
+
+
+def get_codec(codec="auto"):
+    # "auto" picks the fastest codec that is installed, falling back to the
+    # standard library's json module.
+    if not isinstance(codec, str):
+        return codec
+    if codec == "auto":
+        for codec_class in (OrjsonCodec, MsgspecCodec):
+            try:
+                return codec_class()
+            except ImportError:
+                pass
+        return JSONCodec()
+    return CODECS[codec]()
+
+
+DEFAULT_CODEC = get_codec()
+
+
+def dumps(payload):
+    return DEFAULT_CODEC.dumps(payload)
+
+
+def compile_response_model(response_model):
+    # Returns a function that validates (or filters) a view's return value
+    # against `response_model`, leaving already valid models untouched.
+    if response_model is None:
+        return None
+
+    origin = typing.get_origin(response_model)
+    args = typing.get_args(response_model)
+    if origin in (list, tuple, set, Sequence) and len(args) == 1:
+        item_model = args[0]
+        if isinstance(item_model, type) and issubclass(item_model, BaseModel):
+            validate_item = compile_model(item_model)
+            return lambda value: [validate_item(item) for item in value]
+
+    if isinstance(response_model, type) and issubclass(response_model, BaseModel):
+        return compile_model(response_model)
+
+    return lambda value: parse_obj_as(response_model, value)
+
+
+STREAMED_TYPES = (list, tuple, set, Sequence, Iterable, Iterator, AsyncIterator)
+
+
+def compile_item_model(response_model):
+    # Validator for the items of a streamed response, `response_model` being
+    # the model of the whole list.
+    origin = typing.get_origin(response_model)
+    args = typing.get_args(response_model)
+    if origin in STREAMED_TYPES and len(args) == 1:
+        return compile_response_model(args[0])
+    return compile_response_model(response_model)
+
+
+NESTED_MODELS = {}
+
+
+def nested_models(model):
+    # (name, model) of the fields of `model` holding models, on their own or
+    # in containers.
+    nested = NESTED_MODELS.get(model)
+    if nested is None:
+        nested = NESTED_MODELS[model] = tuple(
+            (name, field.type_) for name, field in model.__fields__.items()
+            if isinstance(field.type_, type) and issubclass(field.type_, BaseModel)
+        )
+    return nested
+
+
+def filter_model(model, value):
+    # Strips the fields subclasses of `model` add, at every level. Models
+    # that had nothing to strip are returned as they are.
+    values = value.__dict__
+    changed = type(value) is not model
+    if changed:
+        values = {name: values[name] for name in model.__fields__}
+    for name, field_model in nested_models(model):
+        item = values[name]
+        filtered = filter_nested(field_model, item)
+        if filtered is not item:
+            if not changed:
+                values = dict(values)
+                changed = True
+            values[name] = filtered
+    return values if changed else value
+
+
+def filter_nested(model, value):
+    if isinstance(value, model):
+        return filter_model(model, value)
+    if isinstance(value, (list, tuple, set, frozenset)):
+        items = [filter_nested(model, item) for item in value]
+        if all(a is b for a, b in zip(items, value)):
+            return value
+        return items
+    if isinstance(value, dict):
+        items = {key: filter_nested(model, item) for key, item in value.items()}
+        if all(items[key] is item for key, item in value.items()):
+            return value
+        return items
+    return value
+
+
+def compile_model(model):
+    def validate(value):
+        if not isinstance(value, model):
+            if isinstance(value, BaseModel):
+                value = value.__dict__
+            # Models nested in `value` are kept as they are by pydantic,
+            # subclasses included, they're filtered below.
+            value = model.parse_obj(value)
+        return filter_model(model, value)
+    return validate
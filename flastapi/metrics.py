@@ -0,0 +1,152 @@
+import threading
+import weakref
+from bisect import bisect_left
+from time import perf_counter
+
+from flask import current_app
+
+PHASES = ("extract", "validate", "dependencies", "view", "serialize", "teardown")
+# Upper bounds in seconds, from 10µs up to 2.5s.
+DEFAULT_BUCKETS = (
+    0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+)
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class PhaseTimer:
+    # Attributes the time since the previous lap to a phase. One per request,
+    # handed to the compiled plan through `g`.
+    __slots__ = ("timings", "last")
+
+    def __init__(self):
+        self.timings = {}
+        self.last = perf_counter()
+
+    def lap(self, phase):
+        now = perf_counter()
+        timings = self.timings
+        timings[phase] = timings.get(phase, 0.0) + now - self.last
+        self.last = now
+
+
+def add_counts(total, shards):
+    for key, counts in shards:
+        merged = total.get(key)
+        if merged is None:
+            total[key] = list(counts)
+        else:
+            for index, count in enumerate(counts):
+                merged[index] += count
+
+
+def escape_label(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class ThreadMarker:
+    # Only ever referenced by a thread's local storage, it's freed once the
+    # thread exits.
+    __slots__ = ("__weakref__", )
+
+
+class RequestMetrics:
+    # Per endpoint and phase histograms with fixed buckets. Every thread
+    # counts into its own shards, so observing never takes a lock, except
+    # the first time a thread sees an endpoint and phase. Shards are only
+    # merged when the metrics are read, or when their thread exits.
+    def __init__(self, buckets=DEFAULT_BUCKETS, callback=None):
+        self.buckets = tuple(sorted(buckets))
+        self.callback = callback
+        self.local = threading.local()
+        self.threads = {}
+        self.retired = {}
+        self.lock = threading.RLock()
+
+    def observe(self, endpoint, timings):
+        shards = getattr(self.local, "shards", None)
+        if shards is None:
+            shards = self._add_thread()
+        buckets = self.buckets
+        for phase, elapsed in timings.items():
+            key = (endpoint, phase)
+            counts = shards.get(key)
+            if counts is None:
+                # A count per bucket, one for +Inf and the sum of all values.
+                with self.lock:
+                    counts = shards[key] = [0] * (len(buckets) + 1) + [0.0]
+            counts[bisect_left(buckets, elapsed)] += 1
+            counts[-1] += elapsed
+        if self.callback is not None:
+            self.callback(endpoint, timings)
+
+    def _add_thread(self):
+        # Thread per request servers, and greenlets, would pile up shards
+        # otherwise, they're folded into `retired` when the thread exits.
+        shards = self.local.shards = {}
+        marker = self.local.marker = ThreadMarker()
+        with self.lock:
+            self.threads[id(shards)] = shards
+        weakref.finalize(marker, self._retire, shards)
+        return shards
+
+    def _retire(self, shards):
+        with self.lock:
+            # Shards of threads from before a reset are dropped.
+            if self.threads.pop(id(shards), None) is shards:
+                add_counts(self.retired, shards.items())
+
+    def collect(self):
+        # {(endpoint, phase): (counts per bucket, sum)}, merged over threads.
+        merged = {}
+        with self.lock:
+            add_counts(merged, self.retired.items())
+            shards = [
+                item for shards in self.threads.values() for item in shards.items()
+            ]
+        add_counts(merged, shards)
+        return {key: (counts[:-1], counts[-1]) for key, counts in merged.items()}
+
+    def report(self):
+        report = []
+        for (endpoint, phase), (counts, total) in sorted(self.collect().items()):
+            calls = sum(counts)
+            report.append({
+                "endpoint": endpoint,
+                "phase": phase,
+                "count": calls,
+                "sum": total,
+                "mean": total / calls if calls else 0.0,
+                "buckets": dict(zip(self.buckets + (float("inf"),), counts)),
+            })
+        return report
+
+    def exposition(self):
+        # Prometheus text format, buckets are cumulative there.
+        name = "flastapi_request_phase_seconds"
+        lines = [
+            f"# HELP {name} Time spent per endpoint in each phase of a request.",
+            f"# TYPE {name} histogram",
+        ]
+        bounds = [repr(bound) for bound in self.buckets] + ["+Inf"]
+        for (endpoint, phase), (counts, total) in sorted(self.collect().items()):
+            labels = f'endpoint="{escape_label(endpoint)}",phase="{phase}"'
+            cumulative = 0
+            for bound, count in zip(bounds, counts):
+                cumulative += count
+                lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f"{name}_sum{{{labels}}} {total!r}")
+            lines.append(f"{name}_count{{{labels}}} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        with self.lock:
+            self.threads = {}
+            self.retired = {}
+            self.local = threading.local()
+
+
+def serve_metrics():
+    metrics = current_app.extensions["flastapi"].metrics
+    body = "" if metrics is None else metrics.exposition()
+    return current_app.response_class(body, 200, content_type=PROMETHEUS_CONTENT_TYPE)
@@ -0,0 +1,282 @@
+import hashlib
+import inspect
+import threading
+
+from flask import current_app, request
+from pydantic import BaseModel, schema_of
+
+from .caching import CachePolicy, CachedResponse
+from .encoding import JSONCodec
+from .profiling import dependency_name
+from .routing import PATH_PARAMETER, Router
+from .signature import Dependency, QueryModel
+from .signature.mapper import BodyListParameter, BodyParameter, QueryParameter
+
+REF_PREFIX = "#/components/schemas/"
+CONVERTER_SCHEMAS = {
+    "default": {"type": "string"},
+    "string": {"type": "string"},
+    "path": {"type": "string"},
+    "int": {"type": "integer"},
+    "float": {"type": "number"},
+    "uuid": {"type": "string", "format": "uuid"},
+}
+VALIDATION_ERROR = {
+    "title": "ValidationError",
+    "type": "array",
+    "items": {
+        "type": "object",
+        "properties": {
+            "loc": {"type": "array", "items": {"anyOf": [{"type": "string"}, {"type": "integer"}]}},
+            "msg": {"type": "string"},
+            "type": {"type": "string"},
+        },
+        "required": ["loc", "msg", "type"],
+    },
+}
+QUERY_CONSTRAINTS = (
+    ("ge", "minimum"),
+    ("le", "maximum"),
+    ("min_length", "minLength"),
+    ("max_length", "maxLength"),
+    ("regex", "pattern"),
+    ("min_items", "minItems"),
+    ("max_items", "maxItems"),
+)
+PLAIN_DEFAULTS = (str, int, float, bool, type(None))
+
+
+def openapi_path(rule):
+    return PATH_PARAMETER.sub(lambda match: "{" + match.group(3) + "}", rule)
+
+
+def path_parameter_schema(converter, arguments):
+    if converter == "any" and arguments:
+        choices = [choice.strip().strip("'\"") for choice in arguments.split(",")]
+        return {"type": "string", "enum": choices}
+    return dict(CONVERTER_SCHEMAS.get(converter or "default", {"type": "string"}))
+
+
+def build_openapi(flastapi, title=None, version="0.1.0"):
+    if title is None:
+        title = flastapi.app.name if flastapi.app is not None else "flastapi"
+    return OpenAPIBuilder(flastapi, title, version).build()
+
+
+class OpenAPIBuilder:
+    def __init__(self, flastapi, title, version):
+        self.flastapi = flastapi
+        self.title = title
+        self.version = version
+        self.schemas = {}
+        self.model_schemas = {}
+
+    def build(self):
+        paths = {}
+        for router in self.flastapi.routers:
+            for endpoint in router.endpoints:
+                path = paths.setdefault(openapi_path(endpoint.rule), {})
+                for method in endpoint.methods:
+                    path[method.lower()] = self.operation(endpoint)
+        self.schemas["ValidationError"] = VALIDATION_ERROR
+        return {
+            "openapi": "3.0.3",
+            "info": {"title": self.title, "version": self.version},
+            "paths": paths,
+            "components": {"schemas": dict(sorted(self.schemas.items()))},
+        }
+
+    def add_definitions(self, schema):
+        self.schemas.update(schema.pop("definitions", {}))
+        return schema
+
+    def type_schema(self, annotation):
+        if annotation is inspect.Parameter.empty:
+            return {"type": "string"}
+        if inspect.isclass(annotation) and issubclass(annotation, BaseModel):
+            return self.model_ref(annotation)
+        try:
+            schema = schema_of(annotation, title="", ref_template=REF_PREFIX + "{model}")
+        except (TypeError, ValueError, KeyError):
+            # Types with a registered converter pydantic knows nothing of.
+            return {"type": "string"}
+        schema.pop("title", None)
+        return self.add_definitions(schema)
+
+    def model_schema(self, model):
+        schema = self.model_schemas.get(model)
+        if schema is None:
+            schema = self.add_definitions(model.schema(ref_template=REF_PREFIX + "{model}"))
+            self.model_schemas[model] = schema
+        return schema
+
+    def model_ref(self, model):
+        self.schemas[model.__name__] = self.model_schema(model)
+        return {"$ref": REF_PREFIX + model.__name__}
+
+    def operation(self, endpoint):
+        mapper = endpoint.signature_mapper
+        parameters = []
+        for converter, arguments, name in PATH_PARAMETER.findall(endpoint.rule):
+            parameters.append({
+                "name": name,
+                "in": "path",
+                "required": True,
+                "schema": path_parameter_schema(converter, arguments),
+            })
+        bodies = {}
+        self.collect(mapper, parameters, bodies, set())
+
+        operation = {
+            "operationId": dependency_name(endpoint.view_func),
+            "parameters": parameters,
+            "responses": {"200": self.success_response(endpoint)},
+        }
+        summary = inspect.getdoc(endpoint.view_func)
+        if summary:
+            operation["summary"] = summary.splitlines()[0]
+        if bodies:
+            operation["requestBody"] = self.request_body(bodies)
+        if parameters or bodies:
+            operation["responses"]["400"] = {
+                "description": "Validation error",
+                "content": {"application/json": {
+                    "schema": {"$ref": REF_PREFIX + "ValidationError"}
+                }},
+            }
+        return operation
+
+    def collect(self, mapper, parameters, bodies, seen):
+        # Query parameters of dependencies are part of the operation too.
+        for name, parameter in mapper.parameters.items():
+            if isinstance(parameter, QueryParameter):
+                parameters.append(self.query_parameter(parameter))
+            elif isinstance(parameter, BodyParameter):
+                bodies[name] = parameter
+            elif isinstance(parameter, Dependency):
+                dependency = parameter.resolve(self.flastapi)
+                if dependency.dependency in seen:
+                    continue
+                seen.add(dependency.dependency)
+                if isinstance(dependency, QueryModel):
+                    parameters.extend(self.query_model_parameters(dependency))
+                self.collect(dependency.mapper, parameters, {}, seen)
+
+    def query_parameter(self, parameter):
+        schema = self.type_schema(parameter.parameter_type)
+        query = parameter.query
+        if query is not None:
+            for attribute, keyword in QUERY_CONSTRAINTS:
+                value = getattr(query, attribute)
+                if value is not None:
+                    schema[keyword] = value
+            if query.gt is not None:
+                schema.update(minimum=query.gt, exclusiveMinimum=True)
+            if query.lt is not None:
+                schema.update(maximum=query.lt, exclusiveMaximum=True)
+        if not parameter.required and isinstance(parameter.default, PLAIN_DEFAULTS):
+            if parameter.default is not None:
+                schema["default"] = parameter.default
+        return {
+            "name": parameter.key,
+            "in": "query",
+            "required": parameter.required,
+            "schema": schema,
+        }
+
+    def query_model_parameters(self, dependency):
+        parameters = []
+        for key, (path, _) in dependency.keys.items():
+            model = dependency.dependency
+            required = True
+            for alias in path:
+                fields = {field.alias: field for field in model.__fields__.values()}
+                field = fields[alias]
+                required = required and bool(field.required)
+                schema = self.model_schema(model)["properties"][alias]
+                model = field.type_
+            parameters.append({
+                "name": key,
+                "in": "query",
+                "required": required,
+                "schema": schema,
+            })
+        return parameters
+
+    def body_schema(self, parameter):
+        if isinstance(parameter, BodyListParameter):
+            return {"type": "array", "items": self.model_ref(parameter.item_model)}
+        return self.model_ref(parameter.parameter_type)
+
+    def request_body(self, bodies):
+        required = any(parameter.required for parameter in bodies.values())
+        if len(bodies) == 1:
+            parameter, = bodies.values()
+            schema = self.body_schema(parameter)
+        else:
+            schema = {
+                "type": "object",
+                "properties": {
+                    name: self.body_schema(parameter)
+                    for name, parameter in bodies.items()
+                },
+                "required": [
+                    name for name, parameter in bodies.items()
+                    if parameter.required
+                ],
+            }
+        return {
+            "required": required,
+            "content": {"application/json": {"schema": schema}},
+        }
+
+    def success_response(self, endpoint):
+        response = {"description": "Successful response"}
+        if endpoint.response_model is not None:
+            response["content"] = {"application/json": {
+                "schema": self.type_schema(endpoint.response_model)
+            }}
+        return response
+
+
+class OpenAPIRouter(Router):
+    # Serves the document as pre-serialized bytes. It's built on the first
+    # request, or by `compile` (which `FlastAPI.warmup` calls), and only
+    # rebuilt when routes or dependency overrides change.
+    def __init__(self, flastapi, path="/openapi.json", title=None, version="0.1.0"):
+        super().__init__("flastapi_openapi")
+        self.flastapi = flastapi
+        self.path = path
+        self.title = title
+        self.version = version
+        self.policy = CachePolicy()
+        self.entry = None
+        self.built_for = None
+        self.lock = threading.Lock()
+        self.bp.add_url_rule(path, "openapi", self.serve)
+
+    def document(self):
+        return build_openapi(self.flastapi, self.title, self.version)
+
+    def state(self):
+        flastapi = self.flastapi
+        return (flastapi.version, sum(len(router.endpoints) for router in flastapi.routers))
+
+    def get_entry(self):
+        state = self.state()
+        if self.entry is None or self.built_for != state:
+            with self.lock:
+                if self.entry is None or self.built_for != state:
+                    body = JSONCodec().dumps(self.document())
+                    etag = hashlib.sha1(body).hexdigest()
+                    self.entry = CachedResponse(body, 200, "application/json", etag)
+                    self.built_for = state
+        return self.entry
+
+    def compile(self, flastapi=None):
+        self.get_entry()
+
+    def serve(self):
+        return self.policy.respond(
+            self.get_entry(), request, current_app.response_class
+        )
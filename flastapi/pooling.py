@@ -0,0 +1,170 @@
+import logging
+import threading
+from collections import deque
+from time import perf_counter
+
+from werkzeug.exceptions import ServiceUnavailable
+
+logger = logging.getLogger(__name__)
+_missing = object()
+
+
+class PoolTimeout(ServiceUnavailable):
+    # No resource came free in time, answered with a 503.
+    description = "No resource available, try again later."
+
+
+class ResourcePool:
+    # Keeps up to `max_size` resources made by `factory` around, and lends
+    # them out one request at a time. Idle resources are asked
+    # `health_check(resource)` before being lent out again, unhealthy ones
+    # are handed to `dispose` and replaced.
+    def __init__(
+        self, factory, max_size=10, timeout=None, health_check=None,
+        dispose=None
+    ):
+        if max_size < 1:
+            raise ValueError("A pool needs room for at least one resource")
+        self.factory = factory
+        self.max_size = max_size
+        self.timeout = timeout
+        self.health_check = health_check
+        self.dispose = dispose
+        self.idle = deque()
+        self.size = 0
+        self.condition = threading.Condition()
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self.condition:
+            self.checkouts = 0
+            self.waits = 0
+            self.timeouts = 0
+            self.created = 0
+            self.discarded = 0
+            self.checkout_time = 0.0
+            self.max_checkout_time = 0.0
+
+    def checkout(self):
+        start = perf_counter()
+        deadline = None if self.timeout is None else start + self.timeout
+        while True:
+            resource = self._take(deadline)
+            if resource is _missing:
+                resource = self._create()
+            elif not self._is_healthy(resource):
+                self.discard(resource)
+                continue
+            break
+
+        elapsed = perf_counter() - start
+        with self.condition:
+            self.checkouts += 1
+            self.checkout_time += elapsed
+            if elapsed > self.max_checkout_time:
+                self.max_checkout_time = elapsed
+        return resource
+
+    def _take(self, deadline):
+        # An idle resource, or _missing when there's room to create one.
+        waited = False
+        with self.condition:
+            while not self.idle and self.size >= self.max_size:
+                if not waited:
+                    waited = True
+                    self.waits += 1
+                remaining = None if deadline is None else deadline - perf_counter()
+                if remaining is not None and remaining <= 0:
+                    self.timeouts += 1
+                    raise PoolTimeout()
+                self.condition.wait(remaining)
+            if self.idle:
+                return self.idle.pop()
+            self.size += 1
+            return _missing
+
+    def _create(self):
+        try:
+            resource = self.factory()
+        except BaseException:
+            with self.condition:
+                self.size -= 1
+                self.condition.notify()
+            raise
+        with self.condition:
+            self.created += 1
+        return resource
+
+    def _is_healthy(self, resource):
+        if self.health_check is None:
+            return True
+        try:
+            return self.health_check(resource)
+        except Exception:
+            logger.warning("Health check of a pooled resource failed", exc_info=True)
+            return False
+
+    def checkin(self, resource):
+        with self.condition:
+            self.idle.append(resource)
+            self.condition.notify()
+
+    def discard(self, resource):
+        with self.condition:
+            self.size -= 1
+            self.discarded += 1
+            self.condition.notify()
+        self._dispose(resource)
+
+    def _dispose(self, resource):
+        if self.dispose is None:
+            return
+        try:
+            self.dispose(resource)
+        except Exception:
+            logger.warning("Failed to dispose of a pooled resource", exc_info=True)
+
+    def close(self):
+        # Disposes of the idle resources. Lent out ones come back as usual,
+        # the pool can still be used afterwards.
+        with self.condition:
+            idle, self.idle = self.idle, deque()
+            self.size -= len(idle)
+            self.condition.notify_all()
+        for resource in idle:
+            self._dispose(resource)
+
+    def stats(self):
+        with self.condition:
+            return {
+                "size": self.size,
+                "idle": len(self.idle),
+                "in_use": self.size - len(self.idle),
+                "max_size": self.max_size,
+                "checkouts": self.checkouts,
+                "waits": self.waits,
+                "timeouts": self.timeouts,
+                "created": self.created,
+                "discarded": self.discarded,
+                "mean_checkout": (
+                    self.checkout_time / self.checkouts if self.checkouts else 0.0
+                ),
+                "max_checkout": self.max_checkout_time,
+            }
+
+
+def make_lease(pool):
+    # The context dependency lending out a resource of `pool`, named after
+    # its factory.
+    def lease():
+        resource = pool.checkout()
+        try:
+            yield resource
+        finally:
+            pool.checkin(resource)
+
+    factory = pool.factory
+    lease.__module__ = getattr(factory, "__module__", lease.__module__)
+    lease.__name__ = getattr(factory, "__name__", lease.__name__)
+    lease.__qualname__ = getattr(factory, "__qualname__", lease.__qualname__)
+    return lease
@@ -0,0 +1,315 @@
+import cProfile
+import hmac
+import inspect
+import io
+import marshal
+import pstats
+import random
+import threading
+import tracemalloc
+from time import perf_counter
+
+from flask import current_app, jsonify, request
+
+
+def dependency_name(func):
+    module = getattr(func, "__module__", None)
+    name = getattr(func, "__qualname__", None) or repr(func)
+    return f"{module}.{name}" if module else name
+
+
+class DependencyStats:
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, elapsed):
+        self.calls += 1
+        self.total += elapsed
+        if elapsed > self.max:
+            self.max = elapsed
+
+    def as_dict(self):
+        return {
+            "dependency": self.name,
+            "calls": self.calls,
+            "total": self.total,
+            "mean": self.total / self.calls if self.calls else 0.0,
+            "max": self.max,
+        }
+
+
+class DependencyProfiler:
+    # Records the wall time each dependency takes to produce its value,
+    # excluding the time spent resolving its own dependencies. Context
+    # dependencies are timed up to their `yield`.
+    def __init__(self):
+        self.stats = {}
+        self.lock = threading.Lock()
+
+    def record(self, func, elapsed):
+        stats = self.stats.get(func)
+        if stats is None:
+            with self.lock:
+                stats = self.stats.setdefault(
+                    func, DependencyStats(dependency_name(func))
+                )
+        with self.lock:
+            stats.add(elapsed)
+
+    def wrap(self, func):
+        record = self.record
+
+        # Context dependencies are timed up to their first value, so that one
+        # is yielded by the wrapper. Errors thrown in at that point, and
+        # closing, are passed on to the context by hand.
+        if inspect.isasyncgenfunction(func):
+            async def profiled(**kwargs):
+                start = perf_counter()
+                context = func(**kwargs)
+                value = await context.__anext__()
+                record(func, perf_counter() - start)
+                while True:
+                    try:
+                        sent = yield value
+                    except GeneratorExit:
+                        await context.aclose()
+                        raise
+                    except BaseException as e:
+                        step = context.athrow(e)
+                    else:
+                        step = context.asend(sent)
+                    try:
+                        value = await step
+                    except StopAsyncIteration:
+                        return
+        elif inspect.isgeneratorfunction(func):
+            def profiled(**kwargs):
+                start = perf_counter()
+                context = func(**kwargs)
+                value = next(context)
+                record(func, perf_counter() - start)
+                while True:
+                    try:
+                        sent = yield value
+                    except GeneratorExit:
+                        context.close()
+                        raise
+                    except BaseException as e:
+                        step, argument = context.throw, e
+                    else:
+                        step, argument = context.send, sent
+                    try:
+                        value = step(argument)
+                    except StopIteration:
+                        return
+        elif inspect.iscoroutinefunction(func):
+            async def profiled(**kwargs):
+                start = perf_counter()
+                try:
+                    return await func(**kwargs)
+                finally:
+                    record(func, perf_counter() - start)
+        else:
+            def profiled(**kwargs):
+                start = perf_counter()
+                try:
+                    return func(**kwargs)
+                finally:
+                    record(func, perf_counter() - start)
+        return profiled
+
+    def report(self, top=None, sort_by="total"):
+        with self.lock:
+            stats = [s.as_dict() for s in self.stats.values()]
+        stats.sort(key=lambda s: s[sort_by], reverse=True)
+        return stats[:top] if top else stats
+
+    def reset(self):
+        with self.lock:
+            self.stats = {}
+
+
+# Report sort keys, and their pstats names.
+PROFILE_SORT_KEYS = {"calls": "calls", "total": "tottime", "cumulative": "cumulative"}
+
+
+class RequestProfiler:
+    # Runs a sampled share of requests, and those carrying `header` set to
+    # `secret`, under cProfile (and tracemalloc, with `memory`). Stats are
+    # aggregated per endpoint, in memory.
+    def __init__(self, sample_rate=0.0, header="X-Flastapi-Profile", secret=None, memory=False):
+        self.sample_rate = sample_rate
+        self.header = header
+        self.secret = secret
+        self.memory = memory
+        self.stats = {}
+        self.requests = {}
+        self.allocations = {}
+        self.peaks = {}
+        self.tracing = 0
+        self.started_tracing = False
+        self.lock = threading.Lock()
+
+    def has_secret(self, request):
+        value = request.headers.get(self.header)
+        if self.secret is None or value is None:
+            return False
+        return hmac.compare_digest(value.encode(), self.secret.encode())
+
+    def selects(self, request):
+        if self.has_secret(request):
+            return True
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def profile(self, endpoint, handle, *args):
+        snapshot = self.start_tracing() if self.memory else None
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Some other profiler is active already.
+            profile = None
+        try:
+            return handle(*args)
+        finally:
+            if profile is not None:
+                profile.disable()
+            allocations = peak = None
+            if snapshot is not None:
+                allocations, peak = self.stop_tracing(snapshot)
+            if profile is not None:
+                self.record(endpoint, profile, allocations, peak)
+
+    def start_tracing(self):
+        # tracemalloc is process wide, it runs while any profiled request
+        # does. Allocations of other threads show up in the results.
+        # Tracing that was started by someone else is left running.
+        with self.lock:
+            if not self.tracing:
+                self.started_tracing = not tracemalloc.is_tracing()
+                if self.started_tracing:
+                    tracemalloc.start()
+            self.tracing += 1
+        tracemalloc.reset_peak()
+        return tracemalloc.take_snapshot()
+
+    def stop_tracing(self, before):
+        # Allocations still held once the response is returned, by site.
+        _, peak = tracemalloc.get_traced_memory()
+        after = tracemalloc.take_snapshot()
+        with self.lock:
+            self.tracing -= 1
+            if not self.tracing and self.started_tracing:
+                tracemalloc.stop()
+        allocations = [
+            (str(difference.traceback[0]), difference.size_diff, difference.count_diff)
+            for difference in after.compare_to(before, "lineno")
+            if difference.size_diff > 0
+        ]
+        return allocations, peak
+
+    def record(self, endpoint, profile, allocations, peak):
+        with self.lock:
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+            stats = self.stats.get(endpoint)
+            if stats is None:
+                self.stats[endpoint] = pstats.Stats(profile)
+            else:
+                stats.add(profile)
+            if allocations is None:
+                return
+            sites = self.allocations.setdefault(endpoint, {})
+            for site, size, count in allocations:
+                totals = sites.setdefault(site, [0, 0])
+                totals[0] += size
+                totals[1] += count
+            self.peaks[endpoint] = max(self.peaks.get(endpoint, 0), peak)
+
+    def functions(self, endpoint, top=20, sort_by="cumulative"):
+        with self.lock:
+            stats = self.stats.get(endpoint)
+            entries = [] if stats is None else list(stats.stats.items())
+        functions = [
+            {
+                "function": pstats.func_std_string(function),
+                "calls": calls,
+                "total": total,
+                "cumulative": cumulative,
+            }
+            for function, (_, calls, total, cumulative, _) in entries
+        ]
+        functions.sort(key=lambda f: f[sort_by], reverse=True)
+        return functions[:top]
+
+    def top_allocations(self, endpoint, top=10):
+        with self.lock:
+            sites = list(self.allocations.get(endpoint, {}).items())
+        sites.sort(key=lambda site: site[1][0], reverse=True)
+        return [
+            {"site": site, "size": size, "count": count}
+            for site, (size, count) in sites[:top]
+        ]
+
+    def print_stats(self, endpoint, top=20, sort_by="cumulative"):
+        stream = io.StringIO()
+        with self.lock:
+            stats = self.stats.get(endpoint)
+            if stats is not None:
+                stats.stream = stream
+                stats.sort_stats(PROFILE_SORT_KEYS[sort_by]).print_stats(top)
+        return stream.getvalue()
+
+    def dump(self, endpoint):
+        # Marshalled pstats data, `pstats.Stats(path)` reads it back.
+        with self.lock:
+            stats = self.stats.get(endpoint)
+            if stats is None:
+                return None
+            return marshal.dumps(stats.stats)
+
+    def report(self, top=20, sort_by="cumulative"):
+        with self.lock:
+            requests = dict(self.requests)
+            peaks = dict(self.peaks)
+        report = {}
+        for endpoint, count in requests.items():
+            report[endpoint] = {
+                "requests": count,
+                "functions": self.functions(endpoint, top, sort_by),
+            }
+            if endpoint in peaks:
+                report[endpoint]["peak_memory"] = peaks[endpoint]
+                report[endpoint]["allocations"] = self.top_allocations(endpoint, top)
+        return report
+
+    def reset(self):
+        with self.lock:
+            self.stats = {}
+            self.requests = {}
+            self.allocations = {}
+            self.peaks = {}
+
+
+def serve_profiles():
+    # JSON report of every endpoint, or `?endpoint=...&format=pstats` for
+    # the raw stats of one. Only served to requests with the secret header.
+    profiler = current_app.extensions["flastapi"].request_profiler
+    if profiler is None or not profiler.has_secret(request):
+        return jsonify({"error": "forbidden"}), 403
+    top = request.args.get("top", 20, type=int)
+    sort_by = request.args.get("sort", "cumulative")
+    if sort_by not in PROFILE_SORT_KEYS:
+        return jsonify({"error": f"can't sort by {sort_by!r}"}), 400
+    endpoint = request.args.get("endpoint")
+    if request.args.get("format") == "pstats":
+        dump = None if endpoint is None else profiler.dump(endpoint)
+        if dump is None:
+            return jsonify({"error": "no stats for this endpoint"}), 404
+        return current_app.response_class(dump, 200, mimetype="application/octet-stream")
+    report = profiler.report(top, sort_by)
+    if endpoint is not None:
+        report = {endpoint: report.get(endpoint)}
+    return jsonify(report)
@@ -1,37 +1,63 @@
-from functools import partialmethod, wraps
+import inspect
+import logging
+import re
+import threading
+from functools import partial, partialmethod, wraps
 
-from flask import Blueprint, request, jsonify, g
-from werkzeug.routing import Rule, Map
-from pydantic import BaseModel
+from flask import Blueprint, current_app, request, g, stream_with_context
 from pydantic.error_wrappers import ValidationError
 
+from .caching import CachedResponse
+from .concurrency import run, finalize
+from .encoding import DEFAULT_CODEC, compile_response_model, compile_item_model
+from .metrics import PhaseTimer
+from .profiling import dependency_name
 from .signature import parse_signature
+from .signature.exceptions import InvalidBody, RequestErrors
+from .signature.graph import DependencyGraph, compile_endpoint
+from .streaming import is_stream, make_stream, pick_format
+
+
+logger = logging.getLogger(__name__)
+
+# `<name>` or `<converter(arguments):name>`, as in werkzeug's rules.
+PATH_PARAMETER = re.compile(
+    r"<(?:\s*([A-Za-z_][A-Za-z0-9_]*)\s*(?:\((.*?)\))?\s*:)?\s*([A-Za-z_][A-Za-z0-9_]*)\s*>"
+)
 
 
 def extract_path_parameters(raw_rule):
-    rule = Rule(raw_rule)
-    rule.bind(Map())
-    return list(rule._converters.keys())
+    return [name for _, _, name in PATH_PARAMETER.findall(raw_rule)]
 
 
-def close_open_contexts():
-    if hasattr(g, "contexts"):
-        for context in g.contexts:
-            try:
-                next(context)
-            except StopIteration:
-                pass
+def close_open_contexts(contexts=None, error=None):
+    # Last opened first, and each one only once. As in an ExitStack, a
+    # context failing to close passes its error on to the ones before it.
+    if contexts is None:
+        contexts = g.contexts if hasattr(g, "contexts") else []
+    pending = error
+    while contexts:
+        try:
+            finalize(contexts.pop(), pending)
+        except BaseException as e:
+            pending = e
+    if pending is not error:
+        raise pending
 
 
-def to_dict(payload):
-    if isinstance(payload, dict):
-        for name, value in payload.items():
-            payload[name] = to_dict(value)
-    if isinstance(payload, (set, tuple, list)):
-        payload = [to_dict(p) for p in payload]
-    if isinstance(payload, BaseModel):
-        payload = payload.dict()
-    return payload
+def teardown_contexts(error=None):
+    # Registered as a request teardown, it closes whatever the handler
+    # couldn't: contexts of requests that failed outside of it, or of
+    # streams that were never sent. Sub-requests of a batch leave theirs
+    # to the batch request.
+    if g.get("batch", False):
+        return
+    contexts = g.get("contexts")
+    if contexts:
+        try:
+            close_open_contexts(contexts, error)
+        except Exception:
+            logger.exception("Failed to close context dependencies")
 
 
 def flatten_errors(validation_errors):
@@ -43,40 +69,352 @@ def flatten_errors(validation_errors):
     return errors
 
 
-def make_request_handler(view_func, path_parameters):
-    signature_mapper = parse_signature(view_func, exclude=path_parameters)
+def report_errors(validation_error):
+    if isinstance(validation_error, RequestErrors):
+        return validation_error.report()
+    return flatten_errors(validation_error.errors())
+
+
+def split_status(return_value):
+    if isinstance(return_value, tuple) and len(return_value) == 2:
+        return return_value
+    return return_value, 200
+
+
+def is_success(status):
+    # Statuses can be given as "404 NOT FOUND" as well.
+    if isinstance(status, str):
+        status = status.split(" ", 1)[0]
+    return 200 <= int(status) < 300
+
+
+def make_response(payload, status, codec=DEFAULT_CODEC):
+    response_class = current_app.response_class
+    body = codec.dumps(payload)
+    return response_class(body, status, mimetype="application/json")
+
+
+def make_stream_response(
+    items, status, codec, validate, stream_format, close_contexts=True
+):
+    # Context dependencies stay open until the last item has been sent. The
+    # stream takes them over, request teardown runs before it's sent. Should
+    # it never be, they're closed along with the response.
+    on_close = None
+    if close_contexts:
+        contexts, g.contexts = g.contexts, []
+        on_close = partial(close_open_contexts, contexts)
+    mimetype = pick_format(request, stream_format)
+    stream = make_stream(items, mimetype, codec, validate, on_close=on_close)
+    response_class = current_app.response_class
+    response = response_class(
+        stream_with_context(stream), status, mimetype=mimetype
+    )
+    if on_close is not None:
+        response.call_on_close(on_close)
+    return response
+
+
+def compile_cache_key(cache, view_func, signature_mapper, path_parameters):
+    # Responses are cached on every validated argument of the view, what its
+    # dependencies return (the current user, ...) included, except for the
+    # names the policy ignores. Requests with arguments that can't be keyed
+    # aren't cached.
+    if cache is None:
+        return None
+    endpoint = dependency_name(view_func)
+    key_names = [name for name in path_parameters if name not in cache.ignore]
+    for name, parameter in signature_mapper.parameters.items():
+        if getattr(parameter, "lazy", False):
+            raise TypeError(f"Can't cache {endpoint}, {name} is read lazily")
+        if name not in cache.ignore:
+            key_names.append(name)
+    warned = False
+
+    def cache_key(kwargs):
+        nonlocal warned
+        values = [kwargs.get(name) for name in key_names]
+        try:
+            return cache.make_key(endpoint, values, request)
+        except (TypeError, ValueError):
+            if not warned:
+                warned = True
+                logger.warning(
+                    "Not caching %s, its arguments can't be keyed. Pass the "
+                    "ones that don't matter to CachePolicy(ignore=...)",
+                    endpoint, exc_info=True
+                )
+            return None
+    return cache_key
+
+
+def make_request_handler(view_func, path_parameters, lazy=False, **options):
+    # Lazy handlers parse the view's signature and compile everything on the
+    # first request, or when `build` is called.
+    if not lazy:
+        return compile_request_handler(view_func, path_parameters, **options)
+
+    handler = None
+    lock = threading.Lock()
+
+    def build():
+        nonlocal handler
+        if handler is None:
+            with lock:
+                if handler is None:
+                    handler = compile_request_handler(
+                        view_func, path_parameters, **options
+                    )
+        return handler
+
     def handle_request(*args, **kwargs):
-        g.contexts = []
+        return (handler or build())(*args, **kwargs)
+
+    handle_request.build = build
+    return handle_request
+
+
+def compile_request_handler(
+    view_func, path_parameters, parallel=False, response_model=None,
+    stream=None, cache=None, trusted=False
+):
+    signature_mapper = parse_signature(view_func, exclude=path_parameters)
+    signature_mapper.trust(trusted)
+    signature_mapper.compiler = partial(compile_endpoint, parallel=parallel)
+    DependencyGraph(signature_mapper)
+    view_is_async = inspect.iscoroutinefunction(view_func)
+    validate_response = compile_response_model(response_model)
+    validate_item = compile_item_model(response_model)
+    cache_key = compile_cache_key(
+        cache, view_func, signature_mapper, path_parameters
+    )
+
+    def lookup(kwargs):
+        key = g.cache_key = cache_key(kwargs)
+        return None if key is None else cache.get(key)
+
+    def call_view(get_kwargs, args, kwargs, timer):
         try:
-            kwargs.update(signature_mapper.get_kwargs(request))
+            kwargs.update(get_kwargs(request))
         except ValidationError as e:
-            return_value = flatten_errors(e.errors())
-            return_status = 400
-        else:
-            # TODO: handle return type
+            return report_errors(e), 400
+        if cache is not None:
+            entry = lookup(kwargs)
+            if entry is not None:
+                return entry, entry.status
+        try:
             return_value = view_func(*args, **kwargs)
-            return_status = 200
-            if isinstance(return_value, tuple) and len(return_value) == 2:
-                return_value, return_status = return_value
+        except InvalidBody as e:
+            return report_errors(e.validation_error), 400
+        if timer is not None:
+            timer.lap("view")
+        return_value, return_status = split_status(return_value)
+        # Error responses don't have to look like the response model.
+        if (
+            validate_response is not None and is_success(return_status)
+            and not is_stream(return_value)
+        ):
+            return_value = validate_response(return_value)
+        return return_value, return_status
+
+    async def call_async_view(get_kwargs, args, kwargs, timer):
+        try:
+            if inspect.iscoroutinefunction(get_kwargs):
+                kwargs.update(await get_kwargs(request))
+            else:
+                kwargs.update(get_kwargs(request))
+        except ValidationError as e:
+            return report_errors(e), 400
+        if cache is not None:
+            entry = lookup(kwargs)
+            if entry is not None:
+                return entry, entry.status
+        try:
+            return_value = view_func(*args, **kwargs)
+            if view_is_async:
+                return_value = await return_value
+        except InvalidBody as e:
+            return report_errors(e.validation_error), 400
+        if timer is not None:
+            timer.lap("view")
+        return_value, return_status = split_status(return_value)
+        # Error responses don't have to look like the response model.
+        if (
+            validate_response is not None and is_success(return_status)
+            and not is_stream(return_value)
+        ):
+            return_value = validate_response(return_value)
+        return return_value, return_status
+
+    def handle_request(*args, **kwargs):
+        flastapi = current_app.extensions.get("flastapi")
+        if flastapi is None:
+            return respond(None, args, kwargs, None)
+        profiler = flastapi.request_profiler
+        if profiler is not None and profiler.selects(request):
+            return profiler.profile(
+                request.endpoint, time_request, flastapi, args, kwargs
+            )
+        return time_request(flastapi, args, kwargs)
+
+    def time_request(flastapi, args, kwargs):
+        metrics = flastapi.metrics
+        if metrics is None:
+            return respond(flastapi, args, kwargs, None)
+        # Phases are timed on the request's own timer, the plan reports the
+        # ones it runs itself. Streamed bodies are serialized, and their
+        # contexts closed, after the response is returned, which isn't timed.
+        timer = g.phase_timer = PhaseTimer()
+        try:
+            return respond(flastapi, args, kwargs, timer)
+        finally:
+            metrics.observe(request.endpoint, timer.timings)
 
-        close_open_contexts()
-        return jsonify(to_dict(return_value)), return_status
+    def respond(flastapi, args, kwargs, timer):
+        # Sub-requests of a batch share the contexts of the batch request,
+        # which closes them once every one of them ran, and the dependencies
+        # that don't read the request. The others are cached per sub-request.
+        batched = g.get("batch", False)
+        if not batched:
+            g.contexts = []
+            g.dependency_cache = {}
+        g.request_dependency_cache = {}
+        try:
+            get_kwargs = signature_mapper.get_plan(flastapi)
+            if view_is_async or inspect.iscoroutinefunction(get_kwargs):
+                coroutine = call_async_view(get_kwargs, args, kwargs, timer)
+                return_value, return_status = run(coroutine)
+            else:
+                return_value, return_status = call_view(
+                    get_kwargs, args, kwargs, timer
+                )
+        except Exception as e:
+            # Context dependencies get to see the error, e.g. to roll back.
+            if not batched:
+                close_open_contexts(g.contexts, e)
+            raise
+
+        if isinstance(return_value, CachedResponse):
+            if not batched:
+                close_open_contexts()
+            return cache.respond(
+                return_value, request, current_app.response_class
+            )
+
+        codec = DEFAULT_CODEC if flastapi is None else flastapi.codec
+        if is_stream(return_value):
+            if not is_success(return_status):
+                validate = None
+            else:
+                validate = validate_item
+            return make_stream_response(
+                return_value, return_status, codec, validate, stream,
+                close_contexts=not batched
+            )
+
+        if timer is not None:
+            timer.lap("serialize")
+        if not batched:
+            close_open_contexts()
+        if timer is not None:
+            timer.lap("teardown")
+        response = make_response(return_value, return_status, codec)
+        if timer is not None:
+            timer.lap("serialize")
+        if cache is not None and return_status == 200 and g.cache_key is not None:
+            entry = cache.store(g.cache_key, response)
+            return cache.respond(entry, request, current_app.response_class)
+        return response
+
+    handle_request.signature_mapper = signature_mapper
+    handle_request.build = lambda: handle_request
     return handle_request
 
 
+class Endpoint:
+    def __init__(
+        self, rule, methods, view_func, request_handler, parallel,
+        response_model=None
+    ):
+        self.rule = rule
+        self.methods = methods
+        self.view_func = view_func
+        self.request_handler = request_handler
+        self.parallel = parallel
+        self.response_model = response_model
+
+    @property
+    def signature_mapper(self):
+        return self.request_handler.build().signature_mapper
+
+    def compile(self, flastapi=None):
+        # Builds a lazy handler and, given a FlastAPI instance, its plan.
+        signature_mapper = self.signature_mapper
+        if flastapi is not None:
+            signature_mapper.get_plan(flastapi)
+
+    def describe(self, flastapi=None):
+        DependencyGraph(self.signature_mapper, flastapi)
+        return {
+            "rule": self.rule,
+            "methods": list(self.methods),
+            "view": dependency_name(self.view_func),
+            "parallel": self.parallel,
+            "path_parameters": extract_path_parameters(self.rule),
+            "parameters": self.signature_mapper.describe(flastapi),
+        }
+
+
 class Router:
-    def __init__(self, name):
+    def __init__(self, name, parallel=False, trusted=False, lazy=False):
         self.endpoints = []
         self.bp = Blueprint(name, __name__)
+        self.parallel = parallel
+        self.trusted = trusted
+        self.lazy = lazy
+
+    def _dispatch(
+        self, path, *args, parallel=None, response_model=None, stream=None,
+        cache=None, trusted=None, lazy=None, **kwargs
+    ):
+        if parallel is None:
+            parallel = self.parallel
+        if trusted is None:
+            trusted = self.trusted
+        if lazy is None:
+            lazy = self.lazy
 
-    def _dispatch(self, path, *args, **kwargs):
         def endpoint_wrapper(view_func):
             path_parameters = extract_path_parameters(path)
-            request_handler = make_request_handler(view_func, path_parameters)
+            request_handler = make_request_handler(
+                view_func,
+                path_parameters,
+                lazy=lazy,
+                parallel=parallel,
+                response_model=response_model,
+                stream=stream,
+                cache=cache,
+                trusted=trusted,
+            )
+            self.endpoints.append(Endpoint(
+                path,
+                kwargs.get("methods", ["GET"]),
+                view_func,
+                request_handler,
+                parallel,
+                response_model,
+            ))
             self.bp.route(path, *args, **kwargs)(request_handler)
             return wraps(view_func)(request_handler)
         return endpoint_wrapper
 
+    def describe(self, flastapi=None):
+        return [endpoint.describe(flastapi) for endpoint in self.endpoints]
+
+    def compile(self, flastapi=None):
+        for endpoint in self.endpoints:
+            endpoint.compile(flastapi)
+
     get = partialmethod(_dispatch, methods=["GET"])
     post = partialmethod(_dispatch, methods=["POST"])
     put = partialmethod(_dispatch, methods=["PUT"])
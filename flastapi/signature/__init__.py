@@ -1,15 +1,32 @@
+import asyncio
 import inspect
+import logging
+import threading
+import typing
 
-from flask import current_app, g
+from flask import g, has_app_context
 from pydantic import BaseModel
+from pydantic.error_wrappers import ValidationError
+from pydantic.fields import SHAPE_SINGLETON
 
+from ..concurrency import is_async, finalize
+from ..pooling import ResourcePool, make_lease
+from ..profiling import dependency_name
+from .converters import Query, register_converter
+from .exceptions import ScopeMismatch, RequestErrors
 from .mapper import (
     SignatureMapper,
     BodyParameter,
-    QueryParameter
+    BodyListParameter,
+    QueryParameter,
+    body_list_model,
 )
 
+logger = logging.getLogger(__name__)
+
 DEPENDENCIES = {}
+SCOPES = ("request", "thread", "app")
+_missing = object()
 
 
 def parse_signature(func, exclude=None):
@@ -23,44 +40,544 @@ def parse_signature(func, exclude=None):
         if isinstance(parameter.default, Dependency):
             mapper[name] = parameter.default
         else:
-            parameter_type = parameter.annotation
-            default = parameter.default
-            if issubclass(parameter_type, BaseModel):
+            parameter_type, default, query = query_options(parameter)
+            list_model = body_list_model(parameter_type)
+            if query is not None:
+                mapper[name] = QueryParameter(name, default, parameter_type, query)
+            elif list_model is not None:
+                item_model, lazy = list_model
+                mapper[name] = BodyListParameter(
+                    name, default, parameter_type, item_model, lazy
+                )
+            elif inspect.isclass(parameter_type) and issubclass(parameter_type, BaseModel):
                 mapper[name] = BodyParameter(name, default, parameter_type)
             else:
                 mapper[name] = QueryParameter(name, default, parameter_type)
     return mapper
 
 
-def Depends(dependency):
-    depends = DEPENDENCIES.get(dependency)
+def query_options(parameter):
+    # `Query(...)` can be the default value, or sit in `Annotated` metadata.
+    parameter_type = parameter.annotation
+    default = parameter.default
+    query = None
+    if typing.get_origin(parameter_type) is typing.Annotated:
+        parameter_type, *metadata = typing.get_args(parameter_type)
+        for item in metadata:
+            if isinstance(item, Query):
+                query = item
+    if isinstance(default, Query):
+        query = default
+    if query is not None and (default is query or default is inspect.Parameter.empty):
+        default = query.default
+    return parameter_type, default, query
+
+
+def Depends(dependency, use_cache=True, scope="request"):
+    key = (dependency, use_cache, scope)
+    depends = DEPENDENCIES.get(key)
     if not depends:
-        depends = Dependency(dependency)
-        DEPENDENCIES[dependency] = depends
+        if inspect.isclass(dependency) and issubclass(dependency, BaseModel):
+            dependency_class = QueryModel
+        else:
+            dependency_class = Dependency
+        depends = dependency_class(dependency, use_cache=use_cache, scope=scope)
+        DEPENDENCIES[key] = depends
     return depends
 
 
+def Pooled(
+    factory, max_size=10, timeout=None, health_check=None, dispose=None
+):
+    # One pool per factory and set of options, like `Depends`.
+    key = (factory, max_size, timeout, health_check, dispose)
+    pooled = DEPENDENCIES.get(key)
+    if not pooled:
+        pool = ResourcePool(factory, max_size, timeout, health_check, dispose)
+        pooled = DEPENDENCIES[key] = PooledDependency(pool)
+    return pooled
+
+
+def request_cache(shared=True):
+    # Sub-requests of a batch share the values that don't depend on their
+    # own input, the others are cached per sub-request.
+    if has_app_context():
+        return g.get("dependency_cache" if shared else "request_dependency_cache")
+
+
+class DependencyOverrides(dict):
+    # Every change bumps `version`, which tells compiled plans that the
+    # resolved dependency graph has to be rebuilt.
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.version = 0
+
+    def _changed(self):
+        self.version += 1
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self._changed()
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self._changed()
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def clear(self):
+        super().clear()
+        self._changed()
+
+    def pop(self, *args):
+        value = super().pop(*args)
+        self._changed()
+        return value
+
+    def popitem(self):
+        item = super().popitem()
+        self._changed()
+        return item
+
+    def setdefault(self, key, default=None):
+        value = super().setdefault(key, default)
+        self._changed()
+        return value
+
+    def update(self, *args, **kwargs):
+        super().update(*args, **kwargs)
+        self._changed()
+
+
+class ScopedDependencies:
+    # Holds the values of app and thread scoped dependencies, and the
+    # contexts they opened, until `close` is called.
+    def __init__(self):
+        self.app_values = {}
+        self.thread_values = threading.local()
+        self.contexts = []
+        self.lock = threading.RLock()
+
+    def get_app_value(self, key, factory, *args):
+        value = self.app_values.get(key, _missing)
+        if value is _missing:
+            with self.lock:
+                value = self.app_values.get(key, _missing)
+                if value is _missing:
+                    value = self.app_values[key] = factory(*args)
+        return value
+
+    def get_thread_value(self, key, factory, *args):
+        values = getattr(self.thread_values, "values", None)
+        if values is None:
+            values = self.thread_values.values = {}
+        value = values.get(key, _missing)
+        if value is _missing:
+            value = values[key] = factory(*args)
+        return value
+
+    def forget_thread_value(self, key, value):
+        values = getattr(self.thread_values, "values", None)
+        if values is not None and values.get(key) is value:
+            del values[key]
+
+    def enter(self, context):
+        value = next(context)
+        with self.lock:
+            self.contexts.append(context)
+        return value
+
+    async def enter_async(self, context):
+        value = await context.__anext__()
+        with self.lock:
+            self.contexts.append(context)
+        return value
+
+    def close(self):
+        with self.lock:
+            contexts, self.contexts = self.contexts, []
+            self.app_values = {}
+            self.thread_values = threading.local()
+        # Every context gets closed, a failing one is only logged.
+        for context in reversed(contexts):
+            try:
+                finalize(context)
+            except Exception:
+                logger.exception("Failed to close a scoped dependency")
+
+
+GLOBAL_SCOPE = ScopedDependencies()
+
+
 class Dependency:
-    def __init__(self, dependency):
+    # Self contained dependencies resolve their own parameters, a dependency
+    # graph runs them as a whole.
+    self_contained = False
+    phase = "dependencies"
+
+    def __init__(self, dependency, use_cache=True, scope="request"):
+        if scope not in SCOPES:
+            raise ValueError(f"Unknown dependency scope {scope!r}")
         self.dependency = dependency
-        self.mapper = parse_signature(dependency)
-        self.must_close = inspect.isgeneratorfunction(self.dependency)
-
-    def get_value(self, *args, **kwargs):
-        dependency = self
-        if current_app:
-            overrides = current_app.extensions["flastapi"].dependency_overrides
-            candidate = overrides.get(self.dependency)
+        self.use_cache = use_cache
+        self.scope = scope
+        self.mapper = self.map_parameters()
+        self.must_close = (
+            inspect.isgeneratorfunction(dependency)
+            or inspect.isasyncgenfunction(dependency)
+        )
+        self.is_async = is_async(dependency)
+        self.check_scope()
+
+    def map_parameters(self):
+        return parse_signature(self.dependency)
+
+    def check_scope(self):
+        # A dependency can't outlive the things it was built from.
+        if self.scope == "request":
+            return
+        if self.scope == "app" and self.is_async:
+            raise ScopeMismatch(
+                f"async dependency {self.dependency!r} can't be app scoped, "
+                "it would be bound to a single worker's event loop"
+            )
+        rank = SCOPES.index(self.scope)
+        for name, parameter in self.mapper.parameters.items():
+            if not isinstance(parameter, Dependency):
+                raise ScopeMismatch(
+                    f"{self.scope} scoped dependency {self.dependency!r} "
+                    f"can't use request parameter {name!r}"
+                )
+            if SCOPES.index(parameter.scope) < rank:
+                raise ScopeMismatch(
+                    f"{self.scope} scoped dependency {self.dependency!r} "
+                    f"can't depend on {parameter.scope} scoped {name!r}"
+                )
+
+    def reads_request(self, flastapi=None):
+        # Whether anything in the (resolved) dependency tree is read from the
+        # request itself.
+        for parameter in self.mapper.parameters.values():
+            if not isinstance(parameter, Dependency):
+                return True
+            if parameter.resolve(flastapi).reads_request(flastapi):
+                return True
+        return False
+
+    def resolve(self, flastapi=None):
+        if flastapi is not None:
+            candidate = flastapi.dependency_overrides.get(self.dependency)
             if candidate:
-                dependency = Depends(candidate)
-        return dependency._get_value(*args, **kwargs)
+                return Depends(candidate, self.use_cache, self.scope)
+        return self
+
+    def bind(self, flastapi=None):
+        # The callable that actually gets called, wrapped for timing when
+        # the dependency profiler is on.
+        profiler = None if flastapi is None else flastapi.dependency_profiler
+        if profiler is None:
+            return self.dependency
+        return profiler.wrap(self.dependency)
+
+    def describe(self, name, flastapi=None):
+        dependency = self.resolve(flastapi)
+        return {
+            "name": name,
+            "source": "dependency",
+            "dependency": dependency_name(dependency.dependency),
+            "overridden": dependency is not self,
+            "scope": dependency.scope,
+            "use_cache": dependency.use_cache,
+            "context": dependency.must_close,
+            "async": dependency.is_async,
+            "parameters": dependency.mapper.describe(flastapi),
+        }
+
+    def compile(self, multi_body=False, flastapi=None):
+        # Overrides are resolved here, once per change of the overrides
+        # mapping, instead of being looked up on every call.
+        return self.resolve(flastapi)._compile(flastapi)
+
+    def _compile(self, flastapi=None):
+        dependency = self.bind(flastapi)
+        get_kwargs = self.mapper.compile(flastapi)
+
+        if self.is_async or inspect.iscoroutinefunction(get_kwargs):
+            return self._compile_async(get_kwargs, flastapi)
+
+        if self.scope != "request":
+            return self._scoped(get_kwargs, flastapi)
+
+        if self.must_close:
+            def call(request):
+                context = dependency(**get_kwargs(request))
+                if hasattr(g, "contexts"):
+                    g.contexts.append(context)
+                return next(context)
+        else:
+            def call(request):
+                return dependency(**get_kwargs(request))
+
+        if self.use_cache:
+            call = self._cached(call, flastapi)
+        return call
+
+    def _compile_async(self, get_kwargs, flastapi=None):
+        dependency = self.bind(flastapi)
+        if not inspect.iscoroutinefunction(get_kwargs):
+            get_sync_kwargs = get_kwargs
+
+            async def get_kwargs(request):
+                return get_sync_kwargs(request)
+
+        if self.scope != "request":
+            return self._scoped_async(get_kwargs, flastapi)
+
+        if inspect.isasyncgenfunction(self.dependency):
+            async def call(request):
+                context = dependency(**await get_kwargs(request))
+                if hasattr(g, "contexts"):
+                    g.contexts.append(context)
+                return await context.__anext__()
+        elif inspect.isgeneratorfunction(self.dependency):
+            async def call(request):
+                context = dependency(**await get_kwargs(request))
+                if hasattr(g, "contexts"):
+                    g.contexts.append(context)
+                return next(context)
+        elif inspect.iscoroutinefunction(self.dependency):
+            async def call(request):
+                return await dependency(**await get_kwargs(request))
+        else:
+            async def call(request):
+                return dependency(**await get_kwargs(request))
+
+        if self.use_cache:
+            call = self._cached_async(call, flastapi)
+        return call
+
+    def _scoped(self, get_kwargs, flastapi=None):
+        key = self.dependency
+        dependency = self.bind(flastapi)
+        scopes = GLOBAL_SCOPE if flastapi is None else flastapi.scopes
+        if self.scope == "app":
+            get_value = scopes.get_app_value
+        else:
+            get_value = scopes.get_thread_value
 
-    def _get_value(self, request, *args, **kwargs):
-        kwargs = self.mapper.get_kwargs(request)
         if self.must_close:
-            context = self.dependency(**kwargs)
-            if hasattr(g, "contexts"):
-                g.contexts.append(context)
-            return next(context)
+            def create(request):
+                return scopes.enter(dependency(**get_kwargs(request)))
+        else:
+            def create(request):
+                return dependency(**get_kwargs(request))
+
+        def call(request):
+            return get_value(key, create, request)
+        return call
+
+    def _scoped_async(self, get_kwargs, flastapi=None):
+        # Only thread scoped, the values are awaited on that thread's loop.
+        key = self.dependency
+        dependency = self.bind(flastapi)
+        scopes = GLOBAL_SCOPE if flastapi is None else flastapi.scopes
+
+        if inspect.isasyncgenfunction(key):
+            async def create(request):
+                context = dependency(**await get_kwargs(request))
+                return await scopes.enter_async(context)
+        elif inspect.isgeneratorfunction(key):
+            async def create(request):
+                return scopes.enter(dependency(**await get_kwargs(request)))
+        elif inspect.iscoroutinefunction(key):
+            async def create(request):
+                return await dependency(**await get_kwargs(request))
+        else:
+            async def create(request):
+                return dependency(**await get_kwargs(request))
+
+        def forget_failure(task):
+            # Only values are kept, a failure is retried by the next request.
+            if task.cancelled() or task.exception() is not None:
+                scopes.forget_thread_value(key, task)
+
+        def create_task(request):
+            task = asyncio.ensure_future(create(request))
+            task.add_done_callback(forget_failure)
+            return task
+
+        async def call(request):
+            return await scopes.get_thread_value(key, create_task, request)
+        return call
+
+    def _cached(self, call, flastapi=None):
+        # One evaluation per request, shared by every `Depends` on the same
+        # callable in the endpoint's dependency tree.
+        key = self.dependency
+        shared = not self.reads_request(flastapi)
+
+        def cached_call(request):
+            cache = request_cache(shared)
+            if cache is None:
+                return call(request)
+            value = cache.get(key, _missing)
+            if value is _missing:
+                value = cache[key] = call(request)
+            return value
+        return cached_call
+
+    def _cached_async(self, call, flastapi=None):
+        # The task is cached rather than its result, so concurrent branches
+        # asking for the same dependency all await a single evaluation.
+        key = self.dependency
+        shared = not self.reads_request(flastapi)
+
+        async def cached_call(request):
+            cache = request_cache(shared)
+            if cache is None:
+                return await call(request)
+            task = cache.get(key)
+            if task is None:
+                task = cache[key] = asyncio.ensure_future(call(request))
+            return await task
+        return cached_call
+
+
+class PooledDependency(Dependency):
+    # Lends the request a resource of its pool, which takes it back once the
+    # request's contexts are closed.
+    def __init__(self, pool):
+        self.pool = pool
+        super().__init__(make_lease(pool))
+
+    def resolve(self, flastapi=None):
+        # Overriding the factory replaces the whole pool, e.g. in tests.
+        if flastapi is not None:
+            candidate = flastapi.dependency_overrides.get(self.pool.factory)
+            if candidate:
+                return Depends(candidate, self.use_cache, self.scope)
+        return super().resolve(flastapi)
+
+    def stats(self):
+        return self.pool.stats()
+
+    def close(self):
+        self.pool.close()
+
+
+class QueryModel(Dependency):
+    # Binds `request.args` to a pydantic model, which validates them in a
+    # single pass. Nested models are read from dotted keys (`page.size`),
+    # sequence fields from repeated keys.
+    self_contained = True
+    phase = "extract"
+
+    def __init__(self, dependency, use_cache=True, scope="request"):
+        self.keys = {}
+        self._map_fields(dependency, "", ())
+        super().__init__(dependency, use_cache=use_cache, scope=scope)
+
+    def _map_fields(self, model, prefix, path):
+        for field in model.__fields__.values():
+            if isinstance(field.default, Dependency):
+                continue
+            key = prefix + field.alias
+            field_path = path + (field.alias, )
+            nested = field.type_
+            if field.shape != SHAPE_SINGLETON:
+                self.keys[key] = (field_path, True)
+            elif inspect.isclass(nested) and issubclass(nested, BaseModel):
+                self._map_fields(nested, key + ".", field_path)
+            else:
+                self.keys[key] = (field_path, False)
+
+    def map_parameters(self):
+        # Fields can still default to a dependency of their own.
+        mapper = SignatureMapper(self.dependency)
+        for field in self.dependency.__fields__.values():
+            if isinstance(field.default, Dependency):
+                mapper[field.alias] = field.default
+        return mapper
+
+    def check_scope(self):
+        if self.scope != "request":
+            raise ScopeMismatch(
+                f"{self.scope} scoped dependency {self.dependency!r} "
+                "can't be read from query parameters"
+            )
+
+    def describe(self, name, flastapi=None):
+        description = super().describe(name, flastapi)
+        if isinstance(self.resolve(flastapi), QueryModel):
+            description["parameters"] = [
+                {
+                    "name": field.alias,
+                    "source": "query",
+                    "type": getattr(field.type_, "__name__", repr(field.type_)),
+                    "required": bool(field.required),
+                    "default": None if field.required else field.default,
+                }
+                for field in self.dependency.__fields__.values()
+                if not isinstance(field.default, Dependency)
+            ]
+            description["parameters"] += [
+                parameter.describe(name, flastapi)
+                for name, parameter in self.mapper.parameters.items()
+            ]
+        return description
+
+    def read(self, args):
+        # Only the keys that were sent are looked at, absent fields are left
+        # to the model's defaults.
+        keys = self.keys
+        values = {}
+        for key in args:
+            entry = keys.get(key)
+            if entry is None:
+                continue
+            path, multi = entry
+            value = args.getlist(key) if multi else args[key]
+            if len(path) == 1:
+                values[path[0]] = value
+                continue
+            target = values
+            for part in path[:-1]:
+                target = target.setdefault(part, {})
+            target[path[-1]] = value
+        return values
+
+    def reads_request(self, flastapi=None):
+        return True
+
+    def _compile(self, flastapi=None):
+        model = self.bind(flastapi)
+        read = self.read
+        get_kwargs = self.mapper.compile(flastapi)
+
+        def build(values):
+            try:
+                return model(**values)
+            except ValidationError as e:
+                raise RequestErrors([
+                    (("query", ) + error["loc"], error["msg"], error["type"], error.get("ctx"))
+                    for error in e.errors()
+                ])
+
+        if inspect.iscoroutinefunction(get_kwargs):
+            async def call(request):
+                values = read(request.args)
+                values.update(await get_kwargs(request))
+                return build(values)
+            return self._cached_async(call, flastapi) if self.use_cache else call
+
+        if not self.mapper.parameters:
+            def call(request):
+                return build(read(request.args))
         else:
-            return self.dependency(**kwargs)
+            def call(request):
+                values = read(request.args)
+                values.update(get_kwargs(request))
+                return build(values)
+        return self._cached(call, flastapi) if self.use_cache else call
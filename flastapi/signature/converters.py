@@ -0,0 +1,207 @@
+import inspect
+import re
+import typing
+import uuid
+from collections.abc import Sequence
+from datetime import date, datetime, time
+from decimal import Decimal
+from enum import Enum
+
+_empty = inspect.Parameter.empty
+
+TRUE_VALUES = {"true", "1", "yes", "on", "t", "y"}
+FALSE_VALUES = {"false", "0", "no", "off", "f", "n"}
+MULTI_TYPES = {
+    list: list,
+    set: set,
+    frozenset: frozenset,
+    tuple: tuple,
+    Sequence: list,
+}
+
+
+def to_bool(value):
+    lowered = value.lower()
+    if lowered in TRUE_VALUES:
+        return True
+    if lowered in FALSE_VALUES:
+        return False
+    raise ValueError("value could not be parsed to a boolean")
+
+
+def to_str(value):
+    return value
+
+
+CONVERTERS = {
+    str: to_str,
+    bool: to_bool,
+    int: int,
+    float: float,
+    Decimal: Decimal,
+    uuid.UUID: uuid.UUID,
+    datetime: datetime.fromisoformat,
+    date: date.fromisoformat,
+    time: time.fromisoformat,
+}
+
+
+def register_converter(parameter_type, converter):
+    # `converter` takes the raw query string value and raises a ValueError
+    # (or TypeError) when it can't be converted.
+    CONVERTERS[parameter_type] = converter
+
+
+class Query:
+    # Use as default value of a query parameter to rename it or constrain
+    # its value(s).
+    def __init__(
+        self, default=_empty, *, alias=None, gt=None, ge=None, lt=None,
+        le=None, min_length=None, max_length=None, regex=None,
+        min_items=None, max_items=None
+    ):
+        self.default = default
+        self.alias = alias
+        self.gt = gt
+        self.ge = ge
+        self.lt = lt
+        self.le = le
+        self.min_length = min_length
+        self.max_length = max_length
+        self.regex = regex
+        self.min_items = min_items
+        self.max_items = max_items
+
+
+def compile_choices(choices, describe):
+    # Enum and Literal values are looked up by their string form, enum
+    # members by name as well.
+    lookup = {}
+    for choice, value in choices:
+        lookup.setdefault(str(value), choice)
+    permitted = ", ".join(repr(describe(choice)) for choice, _ in choices)
+
+    def convert(value):
+        choice = lookup.get(value, _empty)
+        if choice is _empty:
+            msg = f"value is not a valid enumeration member; permitted: {permitted}"
+            raise ValueError(msg)
+        return choice
+    return convert
+
+
+def compile_enum(enum_type):
+    members = [(member, member.value) for member in enum_type]
+    members += [(member, name) for name, member in enum_type.__members__.items()]
+    return compile_choices(members, lambda member: member.value)
+
+
+def unwrap_optional(annotation):
+    if typing.get_origin(annotation) is typing.Union:
+        args = [arg for arg in typing.get_args(annotation) if arg is not type(None)]
+        if len(args) == 1:
+            return args[0]
+    return annotation
+
+
+def compile_converter(annotation):
+    # Returns `(convert, container)`. A container type means the parameter
+    # is read with `getlist` and every value is converted on its own.
+    annotation = unwrap_optional(annotation)
+    origin = typing.get_origin(annotation)
+    args = typing.get_args(annotation)
+
+    if origin in MULTI_TYPES:
+        item_type = args[0] if args else str
+        convert, _ = compile_converter(item_type)
+        return convert, MULTI_TYPES[origin]
+    if annotation in MULTI_TYPES:
+        return to_str, MULTI_TYPES[annotation]
+
+    if origin is typing.Literal:
+        return compile_choices([(arg, arg) for arg in args], lambda arg: arg), None
+    if annotation is _empty or annotation is typing.Any:
+        return to_str, None
+
+    if annotation in CONVERTERS:
+        return CONVERTERS[annotation], None
+    if origin is not None:
+        # Unions, mappings and other generics are callable, but can't make
+        # anything of a string.
+        raise TypeError(f"Can't read a query parameter as {annotation!r}")
+    if inspect.isclass(annotation):
+        if issubclass(annotation, Enum):
+            return compile_enum(annotation), None
+        for parameter_type in annotation.__mro__[1:-1]:
+            if parameter_type in CONVERTERS:
+                return CONVERTERS[parameter_type], None
+
+    if not callable(annotation):
+        raise TypeError(f"Can't read a query parameter as {annotation!r}")
+    return annotation, None
+
+
+def compile_constraints(query):
+    # Returns a check for a single value and one for the values of a
+    # multi valued parameter, either of them None if there's nothing to do.
+    if query is None:
+        return None, None
+
+    checks = []
+    if query.gt is not None:
+        gt = query.gt
+        msg = f"ensure this value is greater than {gt}"
+        checks.append(compile_check(lambda value: value > gt, msg))
+    if query.ge is not None:
+        ge = query.ge
+        msg = f"ensure this value is greater than or equal to {ge}"
+        checks.append(compile_check(lambda value: value >= ge, msg))
+    if query.lt is not None:
+        lt = query.lt
+        msg = f"ensure this value is less than {lt}"
+        checks.append(compile_check(lambda value: value < lt, msg))
+    if query.le is not None:
+        le = query.le
+        msg = f"ensure this value is less than or equal to {le}"
+        checks.append(compile_check(lambda value: value <= le, msg))
+    if query.min_length is not None:
+        min_length = query.min_length
+        msg = f"ensure this value has at least {min_length} characters"
+        checks.append(compile_check(lambda value: len(value) >= min_length, msg))
+    if query.max_length is not None:
+        max_length = query.max_length
+        msg = f"ensure this value has at most {max_length} characters"
+        checks.append(compile_check(lambda value: len(value) <= max_length, msg))
+    if query.regex is not None:
+        pattern = re.compile(query.regex)
+        msg = f'string does not match regex "{query.regex}"'
+        checks.append(compile_check(lambda value: pattern.match(value), msg))
+
+    check = None
+    if len(checks) == 1:
+        check = checks[0]
+    elif checks:
+        checks = tuple(checks)
+
+        def check(value):
+            for check_value in checks:
+                check_value(value)
+
+    if query.min_items is None and query.max_items is None:
+        return check, None
+    min_items = query.min_items
+    max_items = query.max_items
+
+    def check_items(values):
+        if min_items is not None and len(values) < min_items:
+            raise ValueError(f"ensure this value has at least {min_items} items")
+        if max_items is not None and len(values) > max_items:
+            raise ValueError(f"ensure this value has at most {max_items} items")
+    return check, check_items
+
+
+def compile_check(passes, msg):
+    def check(value):
+        if not passes(value):
+            raise ValueError(msg)
+    return check
@@ -1,3 +1,7 @@
+from pydantic import BaseModel
+from pydantic.error_wrappers import ValidationError
+
+
 class ParameterParsing(ValueError):
     code = "parsing"
     def __init__(self, message, loc):
@@ -13,3 +17,52 @@ class ParameterParsing(ValueError):
 
 class Missing(ParameterParsing):
     code = "missing"
+
+
+class ScopeMismatch(TypeError):
+    pass
+
+
+class DependencyCycle(TypeError):
+    pass
+
+
+class InvalidBody(ValueError):
+    # Raised while a view consumes a lazily validated body.
+    def __init__(self, validation_error):
+        self.validation_error = validation_error
+
+    def __str__(self):
+        return str(self.validation_error)
+
+
+class RequestErrors(ValidationError):
+    # Request errors as plain (loc, msg, type, ctx) entries. Far cheaper to
+    # collect and report than pydantic's ErrorWrappers, while still being a
+    # ValidationError to anyone catching those.
+    def __init__(self, entries):
+        self.entries = entries
+        self.raw_errors = []
+        self.model = BaseModel
+        self._error_cache = None
+
+    def errors(self):
+        errors = []
+        for loc, msg, error_type, ctx in self.entries:
+            error = {"loc": loc, "msg": msg, "type": error_type}
+            if ctx is not None:
+                error["ctx"] = ctx
+            errors.append(error)
+        return errors
+
+    def report(self):
+        # What ends up in a 400 response, without the error context.
+        return [
+            {"loc": loc, "msg": msg, "type": error_type}
+            for loc, msg, error_type, _ in self.entries
+        ]
+
+
+class FailFast(Exception):
+    # Stops collecting errors once the configured limit is reached.
+    pass
@@ -0,0 +1,225 @@
+from concurrent.futures import wait, FIRST_COMPLETED
+from contextvars import copy_context
+
+from flask import g
+
+from ..concurrency import get_executor
+from ..profiling import dependency_name
+from . import Dependency
+from .exceptions import DependencyCycle, FailFast, RequestErrors
+from .mapper import SignatureMapper, ErrorCollector, error_limit
+
+
+class DependencyNode:
+    def __init__(self, dependency, path):
+        self.dependency = dependency
+        self.path = path
+        self.children = {}
+        self.parents = []
+        self.local = SignatureMapper(dependency.dependency)
+        self.call = None
+
+    @property
+    def inline(self):
+        # Scoped values are bound to the thread asking for them, so they're
+        # never handed to the pool. Neither are cheap, self contained ones.
+        return self.dependency.scope != "request" or self.dependency.self_contained
+
+    def __repr__(self):
+        return f"<DependencyNode {self.dependency.dependency!r}>"
+
+
+class DependencyGraph:
+    def __init__(self, mapper, flastapi=None):
+        self.flastapi = flastapi
+        self.nodes = {}
+        self.resolving = []
+        self.root = SignatureMapper(mapper.func)
+        self.root_children = {}
+        self._add_parameters(mapper, self.root, self.root_children, ())
+
+    def _add_parameters(self, mapper, local, children, path):
+        for name, parameter in mapper.parameters.items():
+            if isinstance(parameter, Dependency):
+                children[name] = self._add_node(parameter, path + (name, ))
+            else:
+                local[name] = parameter
+
+    def _add_node(self, dependency, path):
+        dependency = self._resolve(dependency)
+        key = dependency.dependency if dependency.use_cache else object()
+        node = self.nodes.get(key)
+        if node is not None:
+            return node
+
+        node = self.nodes[key] = DependencyNode(dependency, path)
+        self.resolving.append(dependency.dependency)
+        if node.inline:
+            # Scoped dependencies resolve their own tree in one go.
+            self._check(dependency.mapper)
+        else:
+            self._add_parameters(
+                dependency.mapper, node.local, node.children, path
+            )
+        self.resolving.pop()
+        for child in set(node.children.values()):
+            child.parents.append(node)
+        return node
+
+    def _check(self, mapper):
+        for parameter in mapper.parameters.values():
+            if isinstance(parameter, Dependency):
+                dependency = self._resolve(parameter)
+                self.resolving.append(dependency.dependency)
+                self._check(dependency.mapper)
+                self.resolving.pop()
+
+    def _resolve(self, dependency):
+        dependency = dependency.resolve(self.flastapi)
+        if dependency.dependency in self.resolving:
+            cycle = self.resolving[self.resolving.index(dependency.dependency):]
+            cycle.append(dependency.dependency)
+            names = " -> ".join(dependency_name(func) for func in cycle)
+            raise DependencyCycle(f"Dependency cycle detected: {names}")
+        return dependency
+
+    @property
+    def is_async(self):
+        return any(node.dependency.is_async for node in self.nodes.values())
+
+    def compile(self, timed=False):
+        flastapi = self.flastapi
+        timed = timed and flastapi is not None and flastapi.metrics is not None
+        for node in self.nodes.values():
+            node.call = compile_node(node, flastapi)
+
+        # The pool is only looked up per request, a plan compiled before a
+        # fork doesn't drag its parent's pool along.
+        get_pool = get_executor if flastapi is None else flastapi.get_executor
+        get_root_kwargs = self.root._compile(flastapi, timed)
+        root_children = tuple(self.root_children.items())
+        leaves = tuple(n for n in self.nodes.values() if not n.children)
+        waiting_for = {
+            node: len(set(node.children.values()))
+            for node in self.nodes.values()
+        }
+
+        max_errors = error_limit(flastapi)
+
+        def get_kwargs(request):
+            results = {}
+            errors = ErrorCollector(max_errors)
+            failures = []
+            stopped = []
+            remaining = dict(waiting_for)
+            futures = {}
+            timer = g.phase_timer if timed else None
+
+            def fail(node, error):
+                # Once enough errors are collected nothing new is scheduled,
+                # but running dependencies are still waited for.
+                try:
+                    errors.add(node.path[-1], error, node.path[:-1])
+                except FailFast as e:
+                    stopped.append(e)
+
+            def schedule(node):
+                if node.inline:
+                    try:
+                        finish(node, node.call(request, results))
+                    except ValueError as e:
+                        fail(node, e)
+                    except Exception as e:
+                        failures.append(e)
+                else:
+                    task = copy_context().run
+                    futures[get_pool().submit(task, node.call, request, results)] = node
+
+            def finish(node, result):
+                results[node] = result
+                if failures or stopped:
+                    return
+                for parent in node.parents:
+                    remaining[parent] -= 1
+                    if not remaining[parent]:
+                        schedule(parent)
+
+            if timer is not None:
+                timer.lap("extract")
+            for node in leaves:
+                schedule(node)
+            if timer is not None:
+                timer.lap("dependencies")
+
+            # The endpoint's own parameters are extracted while the first
+            # dependencies are already running.
+            try:
+                kwargs = get_root_kwargs(request)
+            except RequestErrors as e:
+                kwargs = {}
+                try:
+                    errors.add(None, e)
+                except FailFast as e:
+                    stopped.append(e)
+
+            while futures:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    node = futures.pop(future)
+                    try:
+                        result = future.result()
+                    except ValueError as e:
+                        fail(node, e)
+                    except Exception as e:
+                        failures.append(e)
+                    else:
+                        finish(node, result)
+
+            if timer is not None:
+                timer.lap("dependencies")
+            if failures:
+                raise failures[0]
+            errors.raise_errors()
+
+            for name, node in root_children:
+                kwargs[name] = results[node]
+            return kwargs
+        return get_kwargs
+
+
+def compile_node(node, flastapi=None):
+    if node.inline:
+        call_inline = node.dependency._compile(flastapi)
+        return lambda request, results: call_inline(request)
+
+    dependency = node.dependency.bind(flastapi)
+    get_local_kwargs = node.local.compile(flastapi)
+    children = tuple(node.children.items())
+
+    def get_kwargs(request, results):
+        kwargs = get_local_kwargs(request)
+        for name, child in children:
+            kwargs[name] = results[child]
+        return kwargs
+
+    if node.dependency.must_close:
+        def call(request, results):
+            context = dependency(**get_kwargs(request, results))
+            if hasattr(g, "contexts"):
+                g.contexts.append(context)
+            return next(context)
+    else:
+        def call(request, results):
+            return dependency(**get_kwargs(request, results))
+    return call
+
+
+def compile_endpoint(mapper, flastapi=None, parallel=False):
+    # Building the graph checks the resolved dependencies for cycles. In
+    # parallel mode independent sync dependencies run on a thread pool, each
+    # one as soon as all of its own dependencies are resolved. Async
+    # dependency graphs are left to the event loop.
+    graph = DependencyGraph(mapper, flastapi)
+    if not parallel or graph.is_async:
+        return mapper._compile(flastapi, timed=True)
+    return graph.compile(timed=True)
@@ -1,9 +1,27 @@
+import asyncio
 import inspect
+import logging
+import random
+import typing
+from collections.abc import Iterable, Iterator, Sequence
 
+from flask import g
 from pydantic import BaseModel
 from pydantic.error_wrappers import ValidationError, ErrorWrapper
+from pydantic.fields import SHAPE_SINGLETON
 
-from .exceptions import ParameterParsing, Missing
+from ..streaming import iter_json_array
+from .converters import compile_converter, compile_constraints
+from .exceptions import (
+    ParameterParsing,
+    Missing,
+    InvalidBody,
+    RequestErrors,
+    FailFast,
+)
+
+_empty = inspect.Parameter.empty
+logger = logging.getLogger(__name__)
 
 
 class SignatureMapper:
@@ -11,94 +29,544 @@ class SignatureMapper:
         self.func = func
         self.parameters = {}
         self.multi_body = -1
-        self.current_fetcher = None
+        self.plan = None
+        self.plans = {}
+        self.compiler = None
 
     def __setitem__(self, key, value):
         if isinstance(value, BodyParameter):
             self.multi_body += 1
         self.parameters[key] = value
+        self.plan = None
+        self.plans = {}
 
     def __getitem__(self, key):
         return self.parameters[key]
 
     def get_kwargs(self, request):
-        kwargs = {}
-        wrapped_errors = []
-        multi_body = self.multi_body
+        return self.get_plan()(request)
+
+    def get_plan(self, flastapi=None):
+        if flastapi is None:
+            if self.plan is None:
+                self.plan = self.compile()
+            return self.plan
+
+        version = flastapi.version
+        compiled = self.plans.get(flastapi)
+        if compiled is None or compiled[0] != version:
+            compiled = self.plans[flastapi] = (version, self.compile(flastapi))
+        return compiled[1]
+
+    def compile(self, flastapi=None):
+        if self.compiler is not None:
+            return self.compiler(self, flastapi)
+        return self._compile(flastapi)
+
+    def _compile(self, flastapi=None, timed=False):
+        # Bind every parameter to its extractor up front, so a request only
+        # pays for the lookups themselves. Query extractors share a single
+        # `request.args` fetch, everything else receives the request.
+        # Timed plans (an endpoint's own, with metrics on) report each phase
+        # to the request's timer.
+        timed = timed and flastapi is not None and flastapi.metrics is not None
+        multi_body = self.multi_body > 0
+        query_steps = []
+        body_steps = []
+        request_steps = []
+        async_steps = []
         for name, parameter in self.parameters.items():
+            extract = parameter.compile(multi_body, flastapi)
+            if isinstance(parameter, QueryParameter):
+                query_steps.append((name, extract))
+            elif isinstance(parameter, BodyParameter):
+                if parameter.reads_stream(multi_body):
+                    request_steps.append((name, extract, parameter.phase))
+                else:
+                    body_steps.append((name, extract, parameter.loc))
+            elif inspect.iscoroutinefunction(extract):
+                async_steps.append((name, extract))
+            else:
+                request_steps.append((name, extract, parameter.phase))
+        query_steps = tuple(query_steps)
+        body_steps = tuple(body_steps)
+        request_steps = tuple(request_steps)
+        async_steps = tuple(async_steps)
+        get_body = compile_body_loader(flastapi)
+        max_errors = error_limit(flastapi)
+
+        def extract_sync(request, kwargs, errors, timer=None):
+            if query_steps:
+                args = request.args
+                for name, extract in query_steps:
+                    try:
+                        kwargs[name] = extract(args)
+                    except ValueError as e:
+                        errors.add(name, e)
+            if timer is not None:
+                timer.lap("extract")
+            if body_steps:
+                try:
+                    body = get_body(request)
+                except ParameterParsing as e:
+                    for name, extract, loc in body_steps:
+                        errors.add(name, e.__class__(e.message, loc))
+                else:
+                    for name, extract, loc in body_steps:
+                        try:
+                            kwargs[name] = extract(body)
+                        except ValueError as e:
+                            errors.add(name, e)
+                if timer is not None:
+                    timer.lap("validate")
+            for name, extract, phase in request_steps:
+                try:
+                    kwargs[name] = extract(request)
+                except ValueError as e:
+                    errors.add(name, e)
+                if timer is not None:
+                    timer.lap(phase)
+
+        if not async_steps:
+            def get_kwargs(request):
+                kwargs = {}
+                errors = ErrorCollector(max_errors)
+                timer = g.phase_timer if timed else None
+                try:
+                    extract_sync(request, kwargs, errors, timer)
+                except FailFast:
+                    pass
+                errors.raise_errors()
+                return kwargs
+            return get_kwargs
+
+        # Async dependencies don't depend on each other at this level, so
+        # they are awaited concurrently.
+        async def get_kwargs(request):
+            kwargs = {}
+            errors = ErrorCollector(max_errors)
+            timer = g.phase_timer if timed else None
             try:
-                kwargs[name] = parameter.get_value(request, multi_body)
-            except ValidationError as e:
-                for error in e.raw_errors:
-                    error._loc = (name, ) + error.loc_tuple()
-                wrapped_errors.extend(e.raw_errors)
-            except ValueError as e:
-                wrapped_errors.append(ErrorWrapper(e, e.loc))
+                extract_sync(request, kwargs, errors, timer)
+                results = await asyncio.gather(
+                    *(extract(request) for _, extract in async_steps),
+                    return_exceptions=True
+                )
+                if timer is not None:
+                    timer.lap("dependencies")
+                for (name, _), result in zip(async_steps, results):
+                    if isinstance(result, ValueError):
+                        errors.add(name, result)
+                    elif isinstance(result, BaseException):
+                        raise result
+                    else:
+                        kwargs[name] = result
+            except FailFast:
+                pass
+            errors.raise_errors()
+            return kwargs
+        return get_kwargs
 
-        if wrapped_errors:
-            raise ValidationError(wrapped_errors, BaseModel)
+    def describe(self, flastapi=None):
+        return [
+            parameter.describe(name, flastapi)
+            for name, parameter in self.parameters.items()
+        ]
 
-        return kwargs
+    def trust(self, trusted):
+        # Only the endpoint's own bodies, dependencies are shared between
+        # endpoints.
+        sample_share(trusted)
+        for parameter in self.parameters.values():
+            if isinstance(parameter, BodyParameter):
+                parameter.trusted = trusted
+        self.plan = None
+        self.plans = {}
 
     def close(self):
         for context in self.contexts:
             context.finalize()
 
 
+def compile_body_loader(flastapi=None):
+    # The body is parsed once per plan, by the configured codec. Without a
+    # FlastAPI instance it's left to Flask's own `request.json`.
+    codec = None if flastapi is None else flastapi.codec
+
+    def get_body(request):
+        if not request.is_json:
+            msg = "Malformed request. Must be application/json"
+            raise Missing(msg, None)
+        if codec is None:
+            return request.json
+        try:
+            return codec.loads(request.get_data(cache=True))
+        except ValueError as e:
+            raise ParameterParsing(f"Malformed request. Invalid JSON: {e}", None)
+    return get_body
+
+
+def error_limit(flastapi=None):
+    if getattr(flastapi, "fail_fast", False):
+        return 1
+    return getattr(flastapi, "max_errors", None)
+
+
+class ErrorCollector:
+    # Collects request errors as (loc, msg, type, ctx) entries. Only errors
+    # raised by pydantic models go through pydantic's own formatting.
+    def __init__(self, max_errors=None):
+        self.entries = []
+        self.max_errors = max_errors
+
+    def add(self, name, error, prefix=()):
+        entries = self.entries
+        if name is not None:
+            prefix = prefix + (name, )
+        if isinstance(error, ParameterParsing):
+            # Like pydantic, the error's attributes double as its context.
+            entries.append((
+                prefix[:-1] + error.loc, error.message,
+                "value_error." + error.code, error.__dict__
+            ))
+        elif isinstance(error, RequestErrors):
+            entries.extend(
+                (prefix + loc, msg, error_type, ctx)
+                for loc, msg, error_type, ctx in error.entries
+            )
+        elif isinstance(error, ValidationError):
+            entries.extend(
+                (prefix + e["loc"], e["msg"], e["type"], e.get("ctx"))
+                for e in error.errors()
+            )
+        else:
+            wrapper = ErrorWrapper(error, getattr(error, "loc", ()))
+            self.add(name, ValidationError([wrapper], BaseModel), prefix[:-1])
+            return
+
+        max_errors = self.max_errors
+        if max_errors is not None and len(entries) >= max_errors:
+            del entries[max_errors:]
+            raise FailFast
+
+    def raise_errors(self):
+        if self.entries:
+            raise RequestErrors(self.entries)
+
+
 class RequestParameter:
+    phase = "extract"
+
     def __init__(self, name, default, parameter_type):
         self.name = name
         self.default = default
-        self.required = default is inspect._empty
+        self.required = default is _empty
         self.parameter_type = parameter_type
 
     @property
     def loc(self):
         return (self._loc, self.name)
 
-    def get_value(self, request, *args, **kwargs):
-        self.validate(request)
-        return self._get_value(request, *args, **kwargs)
+    def describe(self, name, flastapi=None):
+        parameter_type = self.parameter_type
+        if parameter_type is _empty:
+            parameter_type = None
+        return {
+            "name": name,
+            "source": self._loc,
+            "type": getattr(parameter_type, "__name__", repr(parameter_type)),
+            "required": self.required,
+            "default": None if self.required else self.default,
+        }
 
-    def validate(self, request):
-        pass
+    def compile(self, multi_body=False, flastapi=None):
+        raise NotImplementedError
 
 
 class QueryParameter(RequestParameter):
     _loc = "query"
 
-    def validate(self, request):
-        if self.required and self.name not in request.args:
-            error = ValueError("field required")
-            raise Missing("field required", self.loc)
+    def __init__(self, name, default, parameter_type, query=None):
+        super().__init__(name, default, parameter_type)
+        # Converters are picked when the route is registered, so a type that
+        # can't be read from a query string fails early.
+        self.query = query
+        self.key = name if query is None or query.alias is None else query.alias
+        self.convert, self.container = compile_converter(parameter_type)
+        self.check, self.check_items = compile_constraints(query)
 
-    def _get_value(self, request, *args, **kwargs):
-        value = request.args.get(self.name, inspect._empty)
-        if value is inspect._empty:
-            return self.default
+    @property
+    def loc(self):
+        return (self._loc, self.key)
 
+    def compile(self, multi_body=False, flastapi=None):
+        key = self.key
+        default = self.default
+        required = self.required
+        loc = self.loc
+        convert = self.convert
+        check = self.check
+
+        if check is None:
+            parse = convert
+        else:
+            def parse(value):
+                value = convert(value)
+                check(value)
+                return value
+
+        if self.container is not None:
+            return compile_multi_value(
+                key, default, required, loc, parse, self.container,
+                self.check_items
+            )
+
+        if required:
+            def extract(args):
+                value = args.get(key, _empty)
+                if value is _empty:
+                    raise Missing("field required", loc)
+                try:
+                    return parse(value)
+                except Exception as error:
+                    raise ParameterParsing(str(error), loc)
+        else:
+            def extract(args):
+                value = args.get(key, _empty)
+                if value is _empty:
+                    return default
+                try:
+                    return parse(value)
+                except Exception as error:
+                    raise ParameterParsing(str(error), loc)
+        return extract
+
+
+def compile_multi_value(key, default, required, loc, parse, container, check_items):
+    def extract(args):
+        values = args.getlist(key)
+        if not values:
+            if required:
+                raise Missing("field required", loc)
+            return default
         try:
-            return self.parameter_type(value)
+            values = container([parse(value) for value in values])
+            if check_items is not None:
+                check_items(values)
         except Exception as error:
-            raise ParameterParsing(str(error), self.loc)
+            raise ParameterParsing(str(error), loc)
+        return values
+    return extract
+
+
+def body_list_model(annotation):
+    # `List[Model]` is validated into a list, `Iterator[Model]` into a lazy
+    # iterator. Returns None for anything else.
+    origin = typing.get_origin(annotation)
+    args = typing.get_args(annotation)
+    if origin not in (list, Sequence, Iterable, Iterator) or len(args) != 1:
+        return None
+    item_model = args[0]
+    if not (inspect.isclass(item_model) and issubclass(item_model, BaseModel)):
+        return None
+    return item_model, origin in (Iterable, Iterator)
+
+
+NESTED_MODELS = {}
+
+
+def nested_models(model):
+    fields = NESTED_MODELS.get(model)
+    if fields is None:
+        fields = NESTED_MODELS[model] = [
+            (field.alias, field.type_, field.shape == SHAPE_SINGLETON)
+            for field in model.__fields__.values()
+            if inspect.isclass(field.type_) and issubclass(field.type_, BaseModel)
+        ]
+    return fields
+
+
+def construct_model(model, values):
+    # `construct()` all the way down, nested models included.
+    if not isinstance(values, dict):
+        return values
+    nested = nested_models(model)
+    if nested:
+        values = dict(values)
+        for alias, nested_model, single in nested:
+            value = values.get(alias)
+            if value is None:
+                continue
+            if single:
+                values[alias] = construct_model(nested_model, value)
+            elif isinstance(value, list):
+                values[alias] = [construct_model(nested_model, item) for item in value]
+    return model.construct(**values)
+
+
+def sample_share(trusted):
+    # The share of bodies that is validated. Only booleans and floats are
+    # taken, 1 or 0 could be read either way.
+    if trusted is True:
+        return 0.0
+    if trusted is False:
+        return 1.0
+    if not isinstance(trusted, float) or not 0 <= trusted <= 1:
+        raise ValueError(
+            f"trusted takes a boolean, or the share of bodies to validate "
+            f"between 0.0 and 1.0, not {trusted!r}"
+        )
+    return trusted
+
+
+def compile_model_builder(model, trusted=False):
+    # Trusted bodies are constructed without validation. A float trusts all
+    # but that fraction of them, which is still validated to catch drift.
+    sample_rate = sample_share(trusted)
+    if sample_rate >= 1:
+        return lambda values: model(**values)
+
+    if sample_rate <= 0:
+        return lambda values: construct_model(model, values)
+
+    def build(values):
+        if random.random() >= sample_rate:
+            return construct_model(model, values)
+        try:
+            return model(**values)
+        except ValidationError as e:
+            name = getattr(model, "__name__", repr(model))
+            logger.warning("Trusted %s body failed validation: %s", name, e)
+            raise
+    return build
 
 
 class BodyParameter(RequestParameter):
     _loc = "json"
+    phase = "validate"
+    trusted = False
+
+    def reads_stream(self, multi_body=False):
+        return False
+
+    def compile(self, multi_body=False, flastapi=None):
+        name = self.name
+        default = self.default
+        required = self.required
+        parameter_type = self.parameter_type
+        loc = self.loc
+
+        if self.trusted is not False:
+            build = compile_model_builder(parameter_type, self.trusted)
+
+            def extract(body):
+                if multi_body:
+                    body = body.get(name)
+                if body is None:
+                    if required:
+                        raise Missing("field required", loc)
+                    return default
+                return build(body)
+            return extract
+
+        def extract(body):
+            if multi_body:
+                body = body.get(name)
+
+            if body is None:
+                if required:
+                    raise Missing("field required", loc)
+                return default
+
+            return parameter_type(**body)
+        return extract
+
+
+class BodyListParameter(BodyParameter):
+    def __init__(self, name, default, parameter_type, item_model, lazy=False):
+        super().__init__(name, default, parameter_type)
+        self.item_model = item_model
+        self.lazy = lazy
+
+    def reads_stream(self, multi_body=False):
+        # A lone list body is parsed straight from the request stream. Next
+        # to other body parameters it has to be looked up in the parsed body.
+        return not multi_body
+
+    def compile(self, multi_body=False, flastapi=None):
+        name = self.name
+        default = self.default
+        required = self.required
+        loc = self.loc
+        lazy = self.lazy
+        max_items = getattr(flastapi, "max_body_items", None)
+        max_item_size = getattr(flastapi, "max_body_item_size", None)
+        build = compile_model_builder(self.item_model, self.trusted)
+        validate_items = compile_item_validator(build, max_items)
+
+        if multi_body:
+            def extract(body):
+                items = body.get(name)
+                if items is None:
+                    if required:
+                        raise Missing("field required", loc)
+                    return default
+                if lazy:
+                    return iter_lazily(validate_items(items), name)
+                return collect_items(validate_items(items))
+            return extract
+
+        def extract(request):
+            if not request.is_json:
+                msg = "Malformed request. Must be application/json"
+                raise Missing(msg, loc)
+            items = iter_json_array(request.stream, max_item_size)
+            if lazy:
+                return iter_lazily(validate_items(items), name)
+            return collect_items(validate_items(items))
+        return extract
+
+
+def compile_item_validator(build, max_items=None):
+    # Yields validated items, or the ErrorWrapper of an invalid one, so the
+    # caller decides whether to collect or raise.
+    def validate_items(items):
+        index = -1
+        try:
+            for index, item in enumerate(items):
+                if max_items is not None and index >= max_items:
+                    msg = f"ensure this value has at most {max_items} items"
+                    yield ErrorWrapper(ParameterParsing(msg, ()), (index, ))
+                    return
+                try:
+                    yield build(item)
+                except ValidationError as e:
+                    yield ErrorWrapper(e, (index, ))
+                except TypeError as e:
+                    yield ErrorWrapper(ParameterParsing(str(e), ()), (index, ))
+        except ValueError as e:
+            yield ErrorWrapper(ParameterParsing(str(e), ()), (index + 1, ))
+    return validate_items
 
-    def validate(self, request):
-        if not request.is_json:
-            msg = "Malformed request. Must be application/json"
-            raise Missing(msg, self.loc)
 
-    def _get_value(self, request, multi_param, *args, **kwargs):
-        body = request.json
-        if multi_param:
-            body = body.get(self.name)
+def collect_items(results):
+    items = []
+    errors = []
+    for result in results:
+        if isinstance(result, ErrorWrapper):
+            errors.append(result)
+        else:
+            items.append(result)
+    if errors:
+        raise ValidationError(errors, BaseModel)
+    return items
 
-        if body is None:
-            if self.required: 
-                raise Missing("field required", self.loc)
-            return self.default
 
-        return self.parameter_type(**body)
+def iter_lazily(results, name):
+    # Errors surface while the view consumes the items, routing turns them
+    # into the same 400 response as any other validation error.
+    for result in results:
+        if isinstance(result, ErrorWrapper):
+            result._loc = (name, ) + result.loc_tuple()
+            raise InvalidBody(ValidationError([result], BaseModel))
+        yield result
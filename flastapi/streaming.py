@@ -0,0 +1,156 @@
+import codecs
+import json
+from collections.abc import AsyncIterator, Iterator
+
+from .concurrency import run
+
+JSON = "application/json"
+NDJSON = "application/x-ndjson"
+STREAM_FORMATS = {"json": JSON, "ndjson": NDJSON}
+WHITESPACE = " \t\n\r"
+
+
+def is_stream(value):
+    return isinstance(value, (Iterator, AsyncIterator))
+
+
+def iterate(items):
+    if isinstance(items, AsyncIterator):
+        while True:
+            try:
+                yield run(items.__anext__())
+            except StopAsyncIteration:
+                return
+    else:
+        yield from items
+
+
+def stream_json(items, codec, validate=None, on_close=None):
+    # Renders a JSON array one item at a time. `on_close` gets the error
+    # the stream failed with, if any.
+    error = None
+    try:
+        dumps = codec.dumps
+        separator = b"["
+        for item in iterate(items):
+            if validate is not None:
+                item = validate(item)
+            yield separator + dumps(item)
+            separator = b","
+        yield b"[]" if separator == b"[" else b"]"
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        if on_close is not None:
+            on_close(error)
+
+
+def stream_ndjson(items, codec, validate=None, on_close=None):
+    error = None
+    try:
+        dumps = codec.dumps
+        for item in iterate(items):
+            if validate is not None:
+                item = validate(item)
+            yield dumps(item) + b"\n"
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        if on_close is not None:
+            on_close(error)
+
+
+def pick_format(request, stream_format=None):
+    if stream_format is not None:
+        return STREAM_FORMATS[stream_format]
+    return request.accept_mimetypes.best_match([JSON, NDJSON], JSON)
+
+
+def make_stream(items, mimetype, codec, validate=None, on_close=None):
+    stream = stream_ndjson if mimetype == NDJSON else stream_json
+    return stream(items, codec, validate, on_close)
+
+
+def iter_json_array(stream, max_item_size=None, chunk_size=64 * 1024):
+    # Yields the items of a JSON array read from a binary stream, holding no
+    # more than a chunk and the item being decoded in memory.
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder("utf-8")()
+    buffer = ""
+    pos = 0
+    eof = False
+
+    def fill(wanted=0):
+        # Reads a chunk, and more until `wanted` characters were added.
+        nonlocal buffer, pos, eof
+        parts = [buffer[pos:]]
+        added = 0
+        while True:
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                eof = True
+            part = text.decode(chunk, final=eof)
+            parts.append(part)
+            added += len(part)
+            if eof or added >= wanted:
+                break
+        buffer = "".join(parts)
+        pos = 0
+
+    def skip_whitespace():
+        nonlocal pos
+        while True:
+            while pos < len(buffer) and buffer[pos] in WHITESPACE:
+                pos += 1
+            if pos < len(buffer) or eof:
+                return
+            fill()
+
+    skip_whitespace()
+    if buffer[pos:pos + 1] != "[":
+        raise ValueError("Expected a JSON array")
+    pos += 1
+
+    skip_whitespace()
+    if buffer[pos:pos + 1] == "]":
+        return
+
+    while True:
+        skip_whitespace()
+        while True:
+            try:
+                item, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                item = end = None
+            # A value running up to the end of the buffer might be cut off,
+            # a number for instance, so it's only accepted once a delimiter
+            # follows it.
+            if end is not None and (end < len(buffer) or eof):
+                break
+            if eof:
+                raise ValueError("Invalid JSON array item")
+            if max_item_size and len(buffer) - pos > max_item_size:
+                raise ValueError(
+                    f"Array item exceeds the maximum size of {max_item_size}"
+                )
+            # Decoding starts over from the item's start, so what's pending
+            # is doubled before trying again. Otherwise a large item takes
+            # quadratic time.
+            fill(len(buffer) - pos)
+
+        if max_item_size and end - pos > max_item_size:
+            raise ValueError(
+                f"Array item exceeds the maximum size of {max_item_size}"
+            )
+        pos = end
+        yield item
+
+        skip_whitespace()
+        delimiter = buffer[pos:pos + 1]
+        pos += 1
+        if delimiter == "]":
+            return
+        if delimiter != ",":
+            raise ValueError("Expected ',' or ']' between array items")
@@ -0,0 +1,85 @@
+import datetime
+import decimal
+import json
+import uuid
+from typing import List
+
+import pytest
+from pydantic import BaseModel
+
+from flastapi.encoding import dumps, compile_response_model, get_codec
+
+
+class Child(BaseModel):
+    some_int: int
+
+
+class Parent(BaseModel):
+    some_str: str
+    children: List[Child]
+
+
+def test_it_can_serialize_nested_models_to_bytes():
+    payload = [{"parent": Parent(some_str="a", children=[Child(some_int=1)])}]
+
+    assert dumps(payload) == b'[{"parent":{"some_str":"a","children":[{"some_int":1}]}}]'
+
+
+def test_it_can_serialize_common_types():
+    payload = {
+        "datetime": datetime.datetime(2022, 1, 2, 3, 4, 5),
+        "uuid": uuid.UUID(int=1),
+        "decimal": decimal.Decimal("1.5"),
+        "set": {1},
+        "tuple": (1, 2),
+    }
+
+    assert json.loads(dumps(payload)) == {
+        "datetime": "2022-01-02T03:04:05",
+        "uuid": "00000000-0000-0000-0000-000000000001",
+        "decimal": 1.5,
+        "set": [1],
+        "tuple": [1, 2],
+    }
+
+
+def test_it_leaves_valid_models_untouched():
+    validate = compile_response_model(List[Child])
+    child = Child(some_int=1)
+
+    assert validate([child])[0] is child
+
+
+def test_it_validates_other_response_types():
+    validate = compile_response_model(List[int])
+
+    assert validate(["1", 2]) == [1, 2]
+
+
+@pytest.mark.parametrize("name", ["json", "orjson", "msgspec"])
+def test_codecs_agree_on_the_output(name):
+    if name != "json":
+        pytest.importorskip(name)
+    codec = get_codec(name)
+    payload = {
+        "model": Parent(some_str="a", children=[Child(some_int=1)]),
+        "datetime": datetime.datetime(2022, 1, 2, 3, 4, 5),
+        "uuid": uuid.UUID(int=1),
+        "decimal": decimal.Decimal("1.5"),
+        1: "non string key",
+    }
+
+    assert json.loads(codec.dumps(payload)) == {
+        "model": {"some_str": "a", "children": [{"some_int": 1}]},
+        "datetime": "2022-01-02T03:04:05",
+        "uuid": "00000000-0000-0000-0000-000000000001",
+        "decimal": 1.5,
+        "1": "non string key",
+    }
+    assert codec.loads(b'{"some_int": 1}') == {"some_int": 1}
+
+
+def test_it_can_use_a_custom_codec():
+    codec = object()
+
+    assert get_codec(codec) is codec
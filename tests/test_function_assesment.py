@@ -1,11 +1,18 @@
+from datetime import datetime
+from enum import Enum
+from typing import Annotated, Dict, List, Literal, Optional, Union
 from unittest import mock
 
 import pytest
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from pydantic.error_wrappers import ValidationError
+from werkzeug.datastructures import MultiDict
+from flastapi import FlastAPI, Query, register_converter
 from flastapi.signature import (
-    parse_signature, QueryParameter, BodyParameter, Depends, Dependency
+    parse_signature, QueryParameter, BodyParameter, Depends,
+    DependencyOverrides, QueryModel
 )
+from flastapi.signature.exceptions import ScopeMismatch
 
 
 class SomeParam(BaseModel):
@@ -70,10 +77,11 @@ def test_it_can_assess_a_query_dependency_parameter():
         pass
 
     signature_mapper = parse_signature(func)
-    assert isinstance(signature_mapper["some_param"], Dependency)
-    dependency_mapper = signature_mapper["some_param"].mapper
-    assert isinstance(dependency_mapper["some_int"], QueryParameter)
-    assert isinstance(dependency_mapper["some_str"], QueryParameter)
+    assert isinstance(signature_mapper["some_param"], QueryModel)
+    assert signature_mapper["some_param"].keys == {
+        "some_int": (("some_int", ), False),
+        "some_str": (("some_str", ), False),
+    }
 
 
 def test_it_can_get_correct_kwargs_from_query():
@@ -313,3 +321,244 @@ def test_it_can_ignore_path_parameters():
 
     signature_mapper = parse_signature(func, exclude=["path_param"])
     assert list(signature_mapper.parameters.keys()) == ["some_int"]
+
+
+def test_it_can_compile_a_signature_into_a_plan():
+    request = mock.Mock(
+        args={"some_int": "10"},
+        json={"some_int": "20", "some_str": "test"}
+    )
+
+    def func(some_int: int, some_param: SomeParam, dep: int = Depends(lambda: 1)):
+        pass
+
+    get_kwargs = parse_signature(func).compile()
+    assert get_kwargs(request) == {
+        "some_int": 10,
+        "some_param": SomeParam(some_int=20, some_str="test"),
+        "dep": 1,
+    }
+
+
+def test_it_recompiles_the_plan_when_parameters_change():
+    request = mock.Mock(args={"some_int": "10", "some_str": "test"})
+
+    def func(some_int: int):
+        pass
+
+    signature_mapper = parse_signature(func)
+    assert signature_mapper.get_kwargs(request) == {"some_int": 10}
+
+    signature_mapper["some_str"] = QueryParameter("some_str", "default", str)
+    assert signature_mapper.get_kwargs(request) == {
+        "some_int": 10,
+        "some_str": "test",
+    }
+
+
+def test_it_versions_dependency_overrides():
+    overrides = DependencyOverrides()
+    assert overrides.version == 0
+
+    overrides[SomeParam] = AnotherParam
+    overrides.update({AnotherParam: SomeParam})
+    overrides.pop(SomeParam)
+    overrides.clear()
+    assert overrides.version == 4
+
+
+def test_it_resolves_overrides_when_compiling():
+    request = mock.Mock(args={"some_int": "10", "some_str": "test"})
+    flastapi = FlastAPI()
+    flastapi.dependency_overrides[SomeParam] = AnotherParam
+
+    def func(some_param: SomeParam = Depends(SomeParam)):
+        pass
+
+    kwargs = parse_signature(func).compile(flastapi)(request)
+    assert isinstance(kwargs["some_param"], AnotherParam)
+
+
+def test_it_refuses_to_scope_a_dependency_wider_than_its_parameters():
+    def get_request_value():
+        pass
+
+    def uses_query(some_int: int):
+        pass
+
+    def uses_request_dependency(value: None = Depends(get_request_value)):
+        pass
+
+    with pytest.raises(ScopeMismatch):
+        Depends(uses_query, scope="app")
+
+    with pytest.raises(ScopeMismatch):
+        Depends(uses_request_dependency, scope="thread")
+
+    with pytest.raises(ValueError):
+        Depends(get_request_value, scope="session")
+
+
+def test_it_refuses_to_scope_an_async_dependency_to_the_app():
+    async def get_client():
+        pass
+
+    with pytest.raises(ScopeMismatch):
+        Depends(get_client, scope="app")
+
+
+def test_it_can_cap_the_reported_errors():
+    request = mock.Mock(args={"a": "x", "b": "y"})
+
+    def some_dependency(c: int):
+        pass
+
+    def func(a: int, b: int, dep=Depends(some_dependency)):
+        pass
+
+    signature_mapper = parse_signature(func)
+    with pytest.raises(ValidationError) as exc:
+        signature_mapper.get_plan(FlastAPI())(request)
+    assert [e["loc"] for e in exc.value.errors()] == [
+        ("query", "a"), ("query", "b"), ("dep", "query", "c")
+    ]
+
+    with pytest.raises(ValidationError) as exc:
+        signature_mapper.get_plan(FlastAPI(max_errors=2))(request)
+    assert [e["loc"] for e in exc.value.errors()] == [
+        ("query", "a"), ("query", "b")
+    ]
+
+    with pytest.raises(ValidationError) as exc:
+        signature_mapper.get_plan(FlastAPI(fail_fast=True))(request)
+    assert exc.value.errors() == [{
+        'ctx': {
+            'loc': ('query', 'a'),
+            'message': "invalid literal for int() with base 10: 'x'"
+        },
+        'loc': ('query', 'a'),
+        'msg': "invalid literal for int() with base 10: 'x'",
+        'type': 'value_error.parsing'
+    }]
+
+
+def test_it_can_convert_typed_query_parameters():
+    class Color(Enum):
+        red = "r"
+        green = "g"
+
+    def func(
+        flag: bool,
+        ids: List[int],
+        color: Color,
+        since: datetime,
+        order: Literal["asc", "desc"] = "asc",
+        limit: Optional[int] = None,
+        untyped=None,
+    ):
+        pass
+
+    request = mock.Mock(args=MultiDict([
+        ("flag", "false"), ("ids", "1"), ("ids", "2"), ("color", "green"),
+        ("since", "2024-01-02T03:04:05"), ("limit", "3"), ("untyped", "x"),
+    ]))
+    assert parse_signature(func).get_kwargs(request) == {
+        "flag": False,
+        "ids": [1, 2],
+        "color": Color.green,
+        "since": datetime(2024, 1, 2, 3, 4, 5),
+        "order": "asc",
+        "limit": 3,
+        "untyped": "x",
+    }
+
+    request = mock.Mock(args=MultiDict([
+        ("flag", "maybe"), ("ids", "1"), ("ids", "a"), ("color", "r"),
+        ("since", "2024-01-02"), ("order", "up"),
+    ]))
+    with pytest.raises(ValidationError) as exc:
+        parse_signature(func).get_kwargs(request)
+    assert [(e["loc"], e["msg"]) for e in exc.value.errors()] == [
+        (("query", "flag"), "value could not be parsed to a boolean"),
+        (("query", "ids"), "invalid literal for int() with base 10: 'a'"),
+        (("query", "order"), "value is not a valid enumeration member; permitted: 'asc', 'desc'"),
+    ]
+
+
+def test_it_can_constrain_query_parameters():
+    class Point:
+        def __init__(self, x, y):
+            self.x, self.y = x, y
+
+    register_converter(Point, lambda value: Point(*map(int, value.split(","))))
+
+    def func(
+        page: int = Query(1, ge=1),
+        page_size: Annotated[int, Query(alias="page-size", le=100)] = 10,
+        tags: List[str] = Query([], max_items=2, max_length=3),
+        origin: Point = None,
+    ):
+        pass
+
+    signature_mapper = parse_signature(func)
+    request = mock.Mock(args=MultiDict([("page-size", "20"), ("origin", "1,2")]))
+    kwargs = signature_mapper.get_kwargs(request)
+    assert kwargs["page"] == 1
+    assert kwargs["page_size"] == 20
+    assert kwargs["tags"] == []
+    assert (kwargs["origin"].x, kwargs["origin"].y) == (1, 2)
+
+    request = mock.Mock(args=MultiDict([
+        ("page", "0"), ("page-size", "101"), ("tags", "a"), ("tags", "b"),
+        ("tags", "c"),
+    ]))
+    with pytest.raises(ValidationError) as exc:
+        signature_mapper.get_kwargs(request)
+    assert [(e["loc"], e["msg"]) for e in exc.value.errors()] == [
+        (("query", "page"), "ensure this value is greater than or equal to 1"),
+        (("query", "page-size"), "ensure this value is less than or equal to 100"),
+        (("query", "tags"), "ensure this value has at most 2 items"),
+    ]
+
+
+def test_it_refuses_query_parameters_it_cannot_convert():
+    for annotation in (Union[int, str], Dict[str, int]):
+        def func(value: annotation = None):
+            pass
+
+        with pytest.raises(TypeError):
+            parse_signature(func)
+
+
+def test_it_binds_a_query_model_in_a_single_pass():
+    class Page(BaseModel):
+        number: int = 1
+        size: int = 10
+
+    class Filters(BaseModel):
+        name_contains: str = Field(None, alias="name-contains")
+        ids: List[int] = []
+        page: Page = Page()
+
+    def func(filters: Filters = Depends(Filters)):
+        pass
+
+    signature_mapper = parse_signature(func)
+    request = mock.Mock(args=MultiDict([
+        ("name-contains", "a"), ("ids", "1"), ("ids", "2"), ("page.size", "5"),
+        ("unknown", "x"),
+    ]))
+    filters = signature_mapper.get_kwargs(request)["filters"]
+    assert filters.name_contains == "a"
+    assert filters.ids == [1, 2]
+    assert filters.page == Page(number=1, size=5)
+
+    filters = signature_mapper.get_kwargs(mock.Mock(args=MultiDict()))["filters"]
+    assert filters.page == Page()
+
+    request = mock.Mock(args=MultiDict([("ids", "a"), ("page.number", "b")]))
+    with pytest.raises(ValidationError) as exc:
+        signature_mapper.get_kwargs(request)
+    assert [e["loc"] for e in exc.value.errors()] == [
+        ("filters", "query", "ids", 0), ("filters", "query", "page", "number")
+    ]
@@ -1,10 +1,20 @@
+import marshal
+import threading
+import tracemalloc
+from typing import Iterator, List
 from unittest import mock
 
 import pytest
-from flask import Flask
+from flask import Flask, request
 from pydantic import BaseModel
 
-from flastapi import FlastAPI, Router, Depends
+from flastapi import (
+    FlastAPI, Router, Depends, CachePolicy, MemoryCache, Query, Pooled, ResourcePool
+)
+from flastapi import concurrency
+from flastapi.openapi import build_openapi
+from flastapi.routing import extract_path_parameters
+from flastapi.signature import parse_signature
 
 
 @pytest.fixture
@@ -340,3 +350,1723 @@ def test_it_can_handle_a_malformed_requests(app, flastapi):
         'msg': 'Malformed request. Must be application/json',
         'type': 'value_error.missing'
     }]
+
+
+def test_it_evaluates_a_shared_dependency_once_per_request(app, flastapi):
+    router = Router("test_router")
+    canary = mock.Mock()
+
+    def get_session():
+        canary.enter()
+        yield "session"
+        canary.close()
+
+    def get_user(session: str = Depends(get_session)):
+        return "user"
+
+    def get_permissions(session: str = Depends(get_session)):
+        return "permissions"
+
+    @router.get("/test")
+    def test(
+        session: str = Depends(get_session),
+        user: str = Depends(get_user),
+        permissions: str = Depends(get_permissions),
+    ):
+        return {}
+
+    flastapi.add_router(router)
+
+    with app.app_context():
+        with app.test_client() as client:
+            client.get("/test")
+            client.get("/test")
+
+    assert canary.enter.call_count == 2
+    assert canary.close.call_count == 2
+
+
+def test_it_can_opt_out_of_the_dependency_cache(app, flastapi):
+    router = Router("test_router")
+    canary = mock.Mock()
+
+    def some_dependency():
+        canary()
+
+    def another_dependency(dep: None = Depends(some_dependency, use_cache=False)):
+        pass
+
+    @router.get("/test")
+    def test(
+        some_dep: None = Depends(some_dependency, use_cache=False),
+        another_dep: None = Depends(another_dependency),
+    ):
+        return {}
+
+    flastapi.add_router(router)
+
+    with app.app_context():
+        with app.test_client() as client:
+            client.get("/test")
+
+    assert canary.call_count == 2
+
+
+def test_it_picks_up_dependency_override_changes_between_requests(app, flastapi):
+    router = Router("test_router")
+    canary = mock.Mock()
+
+    def some_dependency():
+        return "test"
+
+    def another_dependency():
+        return "something entirely different"
+
+    def parent_dependency(some_dep: str = Depends(some_dependency)):
+        return some_dep
+
+    @router.get("/test")
+    def test(some_dep: str = Depends(parent_dependency)):
+        canary(some_dep)
+        return {}
+
+    flastapi.add_router(router)
+
+    with app.app_context():
+        with app.test_client() as client:
+            client.get("/test")
+            flastapi.dependency_overrides[some_dependency] = another_dependency
+            client.get("/test")
+            del flastapi.dependency_overrides[some_dependency]
+            client.get("/test")
+            flastapi.dependency_overrides = {some_dependency: another_dependency}
+            client.get("/test")
+
+    assert canary.call_args_list == [
+        mock.call("test"),
+        mock.call("something entirely different"),
+        mock.call("test"),
+        mock.call("something entirely different"),
+    ]
+
+
+def test_it_keeps_app_scoped_dependencies_for_the_lifetime_of_the_app(app, flastapi):
+    router = Router("test_router")
+    canary = mock.Mock()
+
+    def get_engine():
+        canary.enter()
+        yield "engine"
+        canary.close()
+
+    def get_session(engine: str = Depends(get_engine, scope="app")):
+        return engine
+
+    @router.get("/test")
+    def test(session: str = Depends(get_session)):
+        canary(session)
+        return {}
+
+    flastapi.add_router(router)
+
+    with app.app_context():
+        with app.test_client() as client:
+            client.get("/test")
+            client.get("/test")
+
+    assert canary.call_args_list == [mock.call("engine"), mock.call("engine")]
+    canary.enter.assert_called_once()
+    canary.close.assert_not_called()
+
+    flastapi.close()
+    canary.close.assert_called_once()
+
+
+def test_it_closes_every_scoped_dependency(app, flastapi):
+    router = Router("test_router")
+    log = []
+
+    def get_engine():
+        yield "engine"
+        log.append("engine")
+
+    def get_cache():
+        yield "cache"
+        raise RuntimeError("teardown failed")
+
+    @router.get("/test")
+    def test(
+        engine: str = Depends(get_engine, scope="app"),
+        cache: str = Depends(get_cache, scope="app"),
+    ):
+        return {}
+
+    flastapi.add_router(router)
+    flastapi.enable_batch()
+    app.test_client().get("/test")
+    flastapi.batch_router.get_executor()
+
+    flastapi.close()
+    assert log == ["engine"]
+    assert flastapi.batch_router.executor is None
+
+
+def test_it_keeps_thread_scoped_dependencies_per_thread(app, flastapi):
+    import threading
+
+    router = Router("test_router")
+    values = []
+
+    def get_client():
+        return object()
+
+    @router.get("/test")
+    def test(client: object = Depends(get_client, scope="thread")):
+        values.append(client)
+        return {}
+
+    flastapi.add_router(router)
+
+    def do_requests():
+        with app.test_client() as client:
+            client.get("/test")
+            client.get("/test")
+
+    do_requests()
+    thread = threading.Thread(target=do_requests)
+    thread.start()
+    thread.join()
+
+    assert values[0] is values[1]
+    assert values[2] is values[3]
+    assert values[0] is not values[2]
+
+
+def test_it_retries_failed_thread_scoped_async_dependencies(app, flastapi):
+    router = Router("test_router")
+    connect = mock.Mock(side_effect=[ConnectionError(), "client", "other"])
+
+    async def get_client():
+        return connect()
+
+    @router.get("/test")
+    async def test(client: str = Depends(get_client, scope="thread")):
+        return {"client": client}
+
+    flastapi.add_router(router)
+    client = app.test_client()
+
+    with pytest.raises(ConnectionError):
+        client.get("/test")
+    assert client.get("/test").json == {"client": "client"}
+    assert client.get("/test").json == {"client": "client"}
+    assert connect.call_count == 2
+
+    loop = concurrency.get_event_loop()
+    flastapi.close()
+    assert loop.is_closed()
+
+
+def test_it_can_handle_an_async_view_and_dependencies(app, flastapi):
+    router = Router("test_router")
+    canary = mock.Mock()
+
+    async def get_connection():
+        canary.enter()
+        yield "connection"
+        canary.close()
+
+    async def get_user(connection: str = Depends(get_connection)):
+        return f"user from {connection}"
+
+    @router.get("/test")
+    async def test(some_int: int, user: str = Depends(get_user)):
+        canary(some_int, user)
+        return {}
+
+    flastapi.add_router(router)
+
+    with app.app_context():
+        with app.test_client() as client:
+            response = client.get("/test?some_int=1")
+
+    assert response.status_code == 200
+    canary.assert_called_once_with(1, "user from connection")
+    canary.enter.assert_called_once()
+    canary.close.assert_called_once()
+
+
+def test_it_awaits_independent_async_dependencies_concurrently(app, flastapi):
+    import asyncio
+    import time
+
+    router = Router("test_router")
+    canary = mock.Mock()
+
+    async def get_shared():
+        canary.shared()
+        return "shared"
+
+    def make_backend(name):
+        async def backend(shared: str = Depends(get_shared)):
+            await asyncio.sleep(0.1)
+            return name
+        return backend
+
+    @router.get("/test")
+    def test(
+        first: str = Depends(make_backend("first")),
+        second: str = Depends(make_backend("second")),
+        third: str = Depends(make_backend("third")),
+    ):
+        canary(first, second, third)
+        return {}
+
+    flastapi.add_router(router)
+
+    with app.app_context():
+        with app.test_client() as client:
+            start = time.perf_counter()
+            client.get("/test")
+            elapsed = time.perf_counter() - start
+
+    assert elapsed < 0.25
+    canary.assert_called_once_with("first", "second", "third")
+    canary.shared.assert_called_once()
+
+
+def test_it_reports_errors_from_async_dependencies(app, flastapi):
+    router = Router("test_router")
+
+    async def get_page(page: int):
+        return page
+
+    @router.get("/test")
+    def test(page: int = Depends(get_page)):
+        return {}
+
+    flastapi.add_router(router)
+
+    with app.app_context():
+        with app.test_client() as client:
+            response = client.get("/test")
+
+    assert response.status_code == 400
+    assert response.json == [{
+        'loc': ['page', 'query', 'page'],
+        'msg': 'field required',
+        'type': 'value_error.missing'
+    }]
+
+
+def test_it_can_resolve_independent_dependencies_in_parallel(app, flastapi):
+    import time
+
+    router = Router("test_router", parallel=True)
+    canary = mock.Mock()
+
+    def get_session():
+        canary.enter()
+        yield "session"
+        canary.close()
+
+    def make_backend(name):
+        def backend(session: str = Depends(get_session)):
+            time.sleep(0.1)
+            return name
+        return backend
+
+    def get_report(first: str = Depends(make_backend("first"))):
+        return f"report on {first}"
+
+    @router.get("/test")
+    def test(
+        some_int: int,
+        report: str = Depends(get_report),
+        second: str = Depends(make_backend("second")),
+        third: str = Depends(make_backend("third")),
+    ):
+        canary(some_int, report, second, third)
+        return {}
+
+    flastapi.add_router(router)
+
+    with app.app_context():
+        with app.test_client() as client:
+            start = time.perf_counter()
+            client.get("/test?some_int=1")
+            elapsed = time.perf_counter() - start
+
+    assert elapsed < 0.25
+    canary.assert_called_once_with(1, "report on first", "second", "third")
+    canary.enter.assert_called_once()
+    canary.close.assert_called_once()
+
+
+def test_it_collects_errors_from_all_parallel_branches(app, flastapi):
+    router = Router("test_router")
+
+    def get_page(page: int):
+        return page
+
+    def get_size(size: int):
+        return size
+
+    @router.get("/test", parallel=True)
+    def test(
+        some_int: int,
+        page: int = Depends(get_page),
+        size: int = Depends(get_size),
+    ):
+        return {}
+
+    flastapi.add_router(router)
+
+    with app.app_context():
+        with app.test_client() as client:
+            response = client.get("/test")
+
+    assert response.status_code == 400
+    assert sorted(response.json, key=lambda e: e["loc"]) == [
+        {
+            'loc': ['page', 'query', 'page'],
+            'msg': 'field required',
+            'type': 'value_error.missing'
+        }, {
+            'loc': ['query', 'some_int'],
+            'msg': 'field required',
+            'type': 'value_error.missing'
+        }, {
+            'loc': ['size', 'query', 'size'],
+            'msg': 'field required',
+            'type': 'value_error.missing'
+        }
+    ]
+
+
+def test_it_stops_at_the_first_error_in_fail_fast_mode(app):
+    flastapi = FlastAPI(app, fail_fast=True)
+    router = Router("test_router")
+
+    def get_page(page: int):
+        return page
+
+    def get_size(size: int):
+        return size
+
+    @router.get("/test", parallel=True)
+    def test(
+        some_int: int,
+        page: int = Depends(get_page),
+        size: int = Depends(get_size),
+    ):
+        return {}
+
+    flastapi.add_router(router)
+
+    response = app.test_client().get("/test")
+    assert response.status_code == 400
+    assert len(response.json) == 1
+    assert response.json[0]["msg"] == "field required"
+
+
+def test_it_can_describe_the_dependency_tree_of_an_endpoint(app, flastapi):
+    router = Router("test_router")
+
+    class BodyParam(BaseModel):
+        some_int: int
+
+    def get_session():
+        yield "session"
+
+    def get_user(token: str, session: str = Depends(get_session)):
+        return "user"
+
+    @router.post("/test/<int:item_id>")
+    def test(item_id: int, body: BodyParam, user: str = Depends(get_user)):
+        return {}
+
+    flastapi.add_router(router)
+
+    assert flastapi.describe() == [{
+        "rule": "/test/<int:item_id>",
+        "methods": ["POST"],
+        "view": test.__module__ + "." + test.__wrapped__.__qualname__,
+        "parallel": False,
+        "path_parameters": ["item_id"],
+        "parameters": [
+            {
+                "name": "body",
+                "source": "json",
+                "type": "BodyParam",
+                "required": True,
+                "default": None,
+            }, {
+                "name": "user",
+                "source": "dependency",
+                "dependency": get_user.__module__ + "." + get_user.__qualname__,
+                "overridden": False,
+                "scope": "request",
+                "use_cache": True,
+                "context": False,
+                "async": False,
+                "parameters": [
+                    {
+                        "name": "token",
+                        "source": "query",
+                        "type": "str",
+                        "required": True,
+                        "default": None,
+                    }, {
+                        "name": "session",
+                        "source": "dependency",
+                        "dependency": (
+                            get_session.__module__ + "." + get_session.__qualname__
+                        ),
+                        "overridden": False,
+                        "scope": "request",
+                        "use_cache": True,
+                        "context": True,
+                        "async": False,
+                        "parameters": [],
+                    }
+                ],
+            }
+        ],
+    }]
+
+
+def test_it_detects_dependency_cycles_introduced_by_overrides(app, flastapi):
+    from flastapi.signature.exceptions import DependencyCycle
+
+    router = Router("test_router")
+
+    def some_dependency():
+        pass
+
+    def parent_dependency(dep: None = Depends(some_dependency)):
+        pass
+
+    def cyclic_dependency(dep: None = Depends(parent_dependency)):
+        pass
+
+    @router.get("/test")
+    def test(dep: None = Depends(parent_dependency)):
+        return {}
+
+    flastapi.add_router(router)
+    flastapi.dependency_overrides[some_dependency] = cyclic_dependency
+
+    with pytest.raises(DependencyCycle):
+        flastapi.describe()
+
+    with app.app_context():
+        with app.test_client() as client:
+            with pytest.raises(DependencyCycle):
+                client.get("/test")
+
+
+def test_it_can_profile_dependencies(app):
+    import time
+
+    flastapi = FlastAPI(app, profile_dependencies=True)
+    router = Router("test_router")
+
+    def slow_dependency():
+        time.sleep(0.02)
+        yield "slow"
+
+    def fast_dependency(slow: str = Depends(slow_dependency)):
+        return "fast"
+
+    @router.get("/test")
+    def test(fast: str = Depends(fast_dependency)):
+        return {}
+
+    flastapi.add_router(router)
+
+    with app.app_context():
+        with app.test_client() as client:
+            client.get("/test")
+            client.get("/test")
+
+    slowest, fastest = flastapi.dependency_profiler.report()
+    assert slowest["dependency"].endswith("slow_dependency")
+    assert slowest["calls"] == 2
+    assert slowest["total"] >= 0.04
+    assert fastest["dependency"].endswith("fast_dependency")
+    assert fastest["calls"] == 2
+    assert fastest["max"] < 0.02
+
+
+def test_it_throws_errors_into_profiled_context_dependencies(app):
+    flastapi = FlastAPI(app, profile_dependencies=True)
+    router = Router("test_router")
+    log = []
+
+    async def get_session():
+        try:
+            yield "session"
+        except LookupError:
+            log.append("rollback")
+            raise
+        finally:
+            log.append("close")
+
+    def get_cursor():
+        try:
+            yield "cursor"
+        except LookupError:
+            log.append("cursor rollback")
+            raise
+
+    @router.get("/test")
+    async def test(session: str = Depends(get_session), cursor: str = Depends(get_cursor)):
+        raise LookupError("nope")
+
+    @router.get("/ok")
+    async def ok(session: str = Depends(get_session)):
+        return {}
+
+    flastapi.add_router(router)
+    client = app.test_client()
+
+    with pytest.raises(LookupError):
+        client.get("/test")
+    assert log == ["rollback", "close", "cursor rollback"]
+
+    log.clear()
+    assert client.get("/ok").status_code == 200
+    assert log == ["close"]
+
+
+def test_it_can_filter_a_return_value_through_a_response_model(app, flastapi):
+    router = Router("test_router")
+
+    class PublicUser(BaseModel):
+        name: str
+
+    class User(PublicUser):
+        password: str
+
+    @router.get("/test", response_model=PublicUser)
+    def test():
+        return User(name="someone", password="secret")
+
+    flastapi.add_router(router)
+
+    with app.app_context():
+        with app.test_client() as client:
+            payload = client.get("/test")
+
+    assert payload.json == {"name": "someone"}
+
+
+def test_it_filters_models_nested_in_a_response_model(app, flastapi):
+    router = Router("test_router")
+
+    class User(BaseModel):
+        name: str
+
+    class PrivateUser(User):
+        password: str
+
+    class Team(BaseModel):
+        lead: User
+        members: List[User] = []
+
+    class PrivateTeam(Team):
+        budget: int
+
+    @router.get("/test", response_model=Team)
+    def test():
+        return PrivateTeam(
+            lead=PrivateUser(name="a", password="secret"),
+            members=[PrivateUser(name="b", password="secret")],
+            budget=1,
+        )
+
+    @router.get("/missing", response_model=Team)
+    def missing():
+        return {"detail": "not found"}, 404
+
+    flastapi.add_router(router)
+
+    client = app.test_client()
+    assert client.get("/test").json == {"lead": {"name": "a"}, "members": [{"name": "b"}]}
+    # Error responses aren't held to the response model.
+    response = client.get("/missing")
+    assert response.status_code == 404
+    assert response.json == {"detail": "not found"}
+
+
+def test_it_can_validate_a_list_response_model(app, flastapi):
+    from typing import List
+
+    router = Router("test_router")
+
+    class Child(BaseModel):
+        some_int: int
+
+    class Parent(BaseModel):
+        some_int: int
+        child: Child
+
+    @router.get("/test", response_model=List[Parent])
+    def test():
+        return [
+            Parent(some_int=1, child=Child(some_int=2)),
+            {"some_int": "3", "child": {"some_int": "4"}},
+        ], 201
+
+    flastapi.add_router(router)
+
+    with app.app_context():
+        with app.test_client() as client:
+            payload = client.get("/test")
+
+    assert payload.status_code == 201
+    assert payload.json == [
+        {"some_int": 1, "child": {"some_int": 2}},
+        {"some_int": 3, "child": {"some_int": 4}},
+    ]
+
+
+def test_it_fails_on_an_invalid_response(app, flastapi):
+    from pydantic import ValidationError
+
+    router = Router("test_router")
+
+    class BodyParam(BaseModel):
+        some_int: int
+
+    @router.get("/test", response_model=BodyParam)
+    def test():
+        return {"some_int": "not an int"}
+
+    flastapi.add_router(router)
+
+    with app.app_context():
+        with app.test_client() as client:
+            with pytest.raises(ValidationError):
+                client.get("/test")
+
+
+@pytest.mark.parametrize("codec", ["json", "orjson"])
+def test_it_can_parse_bodies_with_the_configured_codec(app, codec):
+    flastapi = FlastAPI(app, codec=codec)
+    router = Router("test_router")
+    canary = mock.Mock()
+
+    class SomeParam(BaseModel):
+        some_int: int
+
+    class AnotherParam(BaseModel):
+        some_str: str
+
+    @router.post("/test")
+    def test(some_param: SomeParam, another_param: AnotherParam):
+        canary(some_param.some_int, another_param.some_str)
+        return {}
+
+    flastapi.add_router(router)
+
+    with app.app_context():
+        with app.test_client() as client:
+            client.post("/test", json={
+                "some_param": {"some_int": 1},
+                "another_param": {"some_str": "test"},
+            })
+            response = client.post(
+                "/test", data="{not json", content_type="application/json"
+            )
+
+    canary.assert_called_once_with(1, "test")
+    assert response.status_code == 400
+    assert [error["loc"] for error in response.json] == [
+        ["json", "some_param"], ["json", "another_param"]
+    ]
+    assert response.json[0]["msg"].startswith("Malformed request. Invalid JSON")
+
+
+def test_it_can_stream_an_iterator_as_a_json_array(app, flastapi):
+    from typing import Iterator
+
+    router = Router("test_router")
+    canary = mock.Mock()
+
+    class Row(BaseModel):
+        some_int: int
+
+    def get_cursor():
+        yield "cursor"
+        canary.close()
+
+    @router.get("/test", response_model=Iterator[Row])
+    def test(cursor: str = Depends(get_cursor)):
+        for i in range(3):
+            canary.produce(i)
+            yield {"some_int": str(i)}
+
+    flastapi.add_router(router)
+
+    client = app.test_client()
+    response = client.get("/test")
+    assert canary.produce.call_count < 3
+    canary.close.assert_not_called()
+    body = response.get_data()
+
+    assert body == b'[{"some_int":0},{"some_int":1},{"some_int":2}]'
+    assert canary.produce.call_count == 3
+    canary.close.assert_called_once()
+
+
+def test_it_can_stream_ndjson(app, flastapi):
+    router = Router("test_router")
+
+    @router.get("/test")
+    async def test():
+        async def rows():
+            for i in range(2):
+                yield {"some_int": i}
+        return rows()
+
+    @router.get("/test-ndjson", stream="ndjson")
+    def test_ndjson():
+        return iter([])
+
+    flastapi.add_router(router)
+
+    client = app.test_client()
+    as_json = client.get("/test")
+    assert as_json.mimetype == "application/json"
+    assert as_json.json == [{"some_int": 0}, {"some_int": 1}]
+
+    as_ndjson = client.get("/test", headers={"Accept": "application/x-ndjson"})
+    assert as_ndjson.mimetype == "application/x-ndjson"
+    assert as_ndjson.get_data() == b'{"some_int":0}\n{"some_int":1}\n'
+
+    empty = client.get("/test-ndjson")
+    assert empty.mimetype == "application/x-ndjson"
+    assert empty.get_data() == b""
+
+
+def test_it_can_handle_a_list_body_request(app, flastapi):
+    router = Router("test_router")
+    canary = mock.Mock()
+
+    class Item(BaseModel):
+        some_int: int
+
+    @router.post("/test")
+    def test(items: List[Item]):
+        canary([item.some_int for item in items])
+        return {}
+
+    flastapi.add_router(router)
+
+    client = app.test_client()
+    response = client.post("/test", json=[{"some_int": 1}, {"some_int": 2}])
+    assert response.status_code == 200
+    canary.assert_called_once_with([1, 2])
+
+    response = client.post("/test", json=[{"some_int": 1}, {"some_int": "a"}])
+    assert response.status_code == 400
+    assert response.json == [{
+        'loc': ['items', 1, 'some_int'],
+        'msg': 'value is not a valid integer',
+        'type': 'type_error.integer'
+    }]
+
+
+def test_it_can_consume_a_list_body_lazily(app):
+    flastapi = FlastAPI(app, max_body_items=2)
+    router = Router("test_router")
+    canary = mock.Mock()
+
+    class Item(BaseModel):
+        some_int: int
+
+    @router.post("/test")
+    def test(items: Iterator[Item]):
+        for item in items:
+            canary(item.some_int)
+        return {}
+
+    flastapi.add_router(router)
+
+    client = app.test_client()
+    response = client.post("/test", json=[{"some_int": 1}, {"some_int": 2}])
+    assert response.status_code == 200
+    assert canary.call_count == 2
+
+    canary.reset_mock()
+    response = client.post("/test", json=[{"some_int": i} for i in range(3)])
+    assert response.status_code == 400
+    assert response.json[0]["loc"] == ["items", 2]
+    assert canary.call_count == 2
+
+    canary.reset_mock()
+    response = client.post(
+        "/test", data='[{"some_int": 1}, oops]',
+        content_type="application/json"
+    )
+    assert response.status_code == 400
+    assert response.json[0]["loc"] == ["items", 1]
+    canary.assert_called_once_with(1)
+
+
+def test_it_can_batch_requests(app, flastapi):
+    router = Router("test_router")
+    canary = mock.Mock()
+
+    class SomeParam(BaseModel):
+        some_int: int
+
+    def get_session():
+        canary.open()
+        yield canary
+        canary.close()
+
+    @router.get("/test/<int:some_id>")
+    def test(some_id: int, some_str: str = "", session=Depends(get_session)):
+        return {"some_id": some_id, "some_str": some_str}
+
+    @router.post("/test")
+    def test_post(some_param: SomeParam, session=Depends(get_session)):
+        return {"some_int": some_param.some_int}, 201
+
+    flastapi.add_router(router)
+    flastapi.enable_batch()
+
+    client = app.test_client()
+    response = client.post("/batch", json=[
+        {"path": "/test/1", "query": {"some_str": "a"}},
+        {"method": "POST", "path": "/test", "body": {"some_int": 2}},
+        {"method": "POST", "path": "/test", "body": {"some_int": "a"}},
+        {"path": "/missing"},
+        {"method": "POST", "path": "/batch", "body": []},
+    ])
+
+    assert response.status_code == 200
+    assert response.json == [
+        {"status": 200, "body": {"some_id": 1, "some_str": "a"}},
+        {"status": 201, "body": {"some_int": 2}},
+        {"status": 400, "body": [{
+            "loc": ["some_param", "some_int"],
+            "msg": "value is not a valid integer",
+            "type": "type_error.integer"
+        }]},
+        {"status": 404, "body": None},
+        {"status": 404, "body": None},
+    ]
+    # The session is shared by every sub-request of the batch.
+    assert canary.open.call_count == 1
+    assert canary.close.call_count == 1
+
+
+def test_it_answers_failing_batch_operations_on_their_own(app, flastapi):
+    router = Router("test_router")
+    log = []
+
+    def get_session():
+        log.append("open")
+        try:
+            yield log
+        except Exception:
+            log.append("rollback")
+            raise
+        log.append("commit")
+
+    @router.post("/write")
+    def write(session=Depends(get_session)):
+        session.append("write")
+        return {}, 201
+
+    @router.get("/fail")
+    def fail(session=Depends(get_session)):
+        raise RuntimeError("boom")
+
+    flastapi.add_router(router)
+    flastapi.enable_batch()
+
+    client = app.test_client()
+    response = client.post("/batch", json=[
+        {"method": "POST", "path": "/write"},
+        {"path": "/fail"},
+        {"method": "POST", "path": "/write"},
+    ])
+
+    assert response.status_code == 200
+    assert [operation["status"] for operation in response.json] == [201, 500, 201]
+    assert log == ["open", "write", "write", "commit"]
+
+
+def test_it_keeps_request_input_apart_in_batches(app, flastapi):
+    router = Router("test_router")
+    canary = mock.Mock()
+
+    class Filter(BaseModel):
+        page: int = 1
+
+    def get_settings():
+        canary.settings()
+        return {}
+
+    def get_item(item_id: int, settings=Depends(get_settings)):
+        return {"item_id": item_id}
+
+    @router.get("/item")
+    def item(item=Depends(get_item), settings=Depends(get_settings)):
+        return item
+
+    @router.get("/filtered")
+    def filtered(f: Filter = Depends(Filter)):
+        return {"page": f.page}
+
+    flastapi.add_router(router)
+    flastapi.enable_batch()
+
+    client = app.test_client()
+    response = client.post("/batch", json=[
+        {"path": "/item", "query": {"item_id": 1}},
+        {"path": "/item", "query": {"item_id": 2}},
+        {"path": "/filtered", "query": {"page": 1}},
+        {"path": "/filtered", "query": {"page": 2}},
+    ])
+
+    assert [operation["body"] for operation in response.json] == [
+        {"item_id": 1}, {"item_id": 2}, {"page": 1}, {"page": 2},
+    ]
+    # Dependencies that don't read the request are still shared.
+    assert canary.settings.call_count == 1
+
+
+def test_it_can_batch_requests_in_parallel(app, flastapi):
+    router = Router("test_router")
+
+    @router.get("/test/<int:some_id>")
+    def test(some_id: int):
+        return {"some_id": some_id}
+
+    flastapi.add_router(router)
+    flastapi.enable_batch(parallel=True, max_operations=3)
+
+    client = app.test_client()
+    response = client.post("/batch", json=[
+        {"path": f"/test/{i}"} for i in range(3)
+    ])
+    assert response.json == [
+        {"status": 200, "body": {"some_id": i}} for i in range(3)
+    ]
+
+    response = client.post("/batch", json=[
+        {"path": f"/test/{i}"} for i in range(4)
+    ])
+    assert response.status_code == 400
+    flastapi.close()
+
+
+def test_it_can_cache_responses(app, flastapi):
+    router = Router("test_router")
+    canary = mock.Mock()
+
+    def get_user():
+        canary.get_user()
+        return "user"
+
+    @router.get("/test/<int:some_id>", cache=CachePolicy(ttl=60, vary=["X-Tenant"]))
+    def test(some_id: int, some_str: str = "", user=Depends(get_user)):
+        canary.view(some_id, some_str)
+        return {"some_id": some_id, "some_str": some_str}
+
+    flastapi.add_router(router)
+
+    client = app.test_client()
+    first = client.get("/test/1?some_str=a")
+    assert first.json == {"some_id": 1, "some_str": "a"}
+    assert first.headers["Cache-Control"] == "max-age=60"
+    assert first.headers["Vary"] == "X-Tenant"
+    etag = first.headers["ETag"]
+
+    second = client.get("/test/1?some_str=a")
+    assert second.get_data() == first.get_data()
+    assert second.headers["ETag"] == etag
+    assert canary.view.call_count == 1
+    # Dependencies still run, they might guard the endpoint.
+    assert canary.get_user.call_count == 2
+
+    not_modified = client.get("/test/1?some_str=a", headers={"If-None-Match": etag})
+    assert not_modified.status_code == 304
+    assert not_modified.get_data() == b""
+    assert canary.view.call_count == 1
+
+    client.get("/test/1?some_str=b")
+    client.get("/test/1?some_str=a", headers={"X-Tenant": "other"})
+    assert canary.view.call_count == 3
+
+    response = client.get("/test/1?some_str=a", headers={"If-None-Match": '"nope"'})
+    assert response.status_code == 200
+    assert canary.view.call_count == 3
+
+
+def test_it_evicts_cached_responses(app, flastapi):
+    router = Router("test_router")
+    canary = mock.Mock()
+
+    @router.get("/test/<int:some_id>", cache=CachePolicy(max_entries=2))
+    def test(some_id: int):
+        canary(some_id)
+        return {}
+
+    flastapi.add_router(router)
+
+    client = app.test_client()
+    for some_id in (1, 2, 1, 3, 1, 2):
+        client.get(f"/test/{some_id}")
+    assert [c.args[0] for c in canary.call_args_list] == [1, 2, 3, 2]
+
+
+def test_it_keys_cached_responses_on_what_dependencies_read(app, flastapi):
+    router = Router("test_router")
+
+    class Filter(BaseModel):
+        page: int = 1
+
+    def get_size(size: int = 10):
+        return size
+
+    def get_limit(size: int = Depends(get_size)):
+        return size
+
+    class Item(BaseModel):
+        some_int: int
+
+    def read_item(item: Item):
+        return item.dict()
+
+    @router.get("/cached", cache=CachePolicy())
+    def cached(f: Filter = Depends(Filter), limit: int = Depends(get_limit)):
+        return {"page": f.page, "limit": limit}
+
+    @router.post("/cached_body", cache=CachePolicy())
+    def cached_body(item=Depends(read_item)):
+        return item
+
+    flastapi.add_router(router)
+
+    client = app.test_client()
+    assert client.get("/cached?page=1").json == {"page": 1, "limit": 10}
+    assert client.get("/cached?page=2").json == {"page": 2, "limit": 10}
+    assert client.get("/cached?page=2&size=5").json == {"page": 2, "limit": 5}
+    assert client.post("/cached_body", json={"some_int": 1}).json == {"some_int": 1}
+    assert client.post("/cached_body", json={"some_int": 2}).json == {"some_int": 2}
+
+
+def test_it_keys_cached_responses_on_dependency_values(app, flastapi):
+    router = Router("test_router")
+    canary = mock.Mock()
+
+    def get_user():
+        return request.headers["Authorization"]
+
+    def get_session():
+        return object()
+
+    @router.get("/me", cache=CachePolicy(ttl=60))
+    def me(user=Depends(get_user)):
+        return {"user": user}
+
+    @router.get("/session", cache=CachePolicy(ignore=["session"]))
+    def session(session=Depends(get_session)):
+        canary.session()
+        return {}
+
+    @router.get("/unkeyed", cache=CachePolicy())
+    def unkeyed(session=Depends(get_session)):
+        canary.unkeyed()
+        return {}
+
+    flastapi.add_router(router)
+
+    client = app.test_client()
+    alice = client.get("/me", headers={"Authorization": "alice"})
+    bob = client.get("/me", headers={"Authorization": "bob"})
+    assert alice.json == {"user": "alice"}
+    assert bob.json == {"user": "bob"}
+    assert bob.headers["Cache-Control"] == "private, max-age=60"
+
+    for _ in range(2):
+        client.get("/session")
+        client.get("/unkeyed")
+    assert canary.session.call_count == 1
+    assert canary.unkeyed.call_count == 2
+
+
+def test_it_expires_cached_responses():
+    cache = MemoryCache()
+    with mock.patch("flastapi.caching.time.monotonic", return_value=10):
+        cache.set("key", "entry", ttl=5)
+        assert cache.get("key") == "entry"
+    with mock.patch("flastapi.caching.time.monotonic", return_value=15):
+        assert cache.get("key") is None
+    assert len(cache) == 0
+
+
+def test_it_can_trust_bodies(app, flastapi):
+    router = Router("test_router", trusted=True)
+    canary = mock.Mock()
+
+    class Child(BaseModel):
+        some_int: int
+
+    class SomeParam(BaseModel):
+        some_int: int
+        child: Child
+        children: List[Child] = []
+
+    @router.post("/trusted")
+    def trusted(some_param: SomeParam):
+        canary(some_param)
+        return {}
+
+    @router.post("/strict", trusted=False)
+    def strict(some_param: SomeParam):
+        return {}
+
+    flastapi.add_router(router)
+
+    client = app.test_client()
+    body = {"some_int": "a", "child": {"some_int": 1}, "children": [{"some_int": 2}]}
+    assert client.post("/trusted", json=body).status_code == 200
+    some_param = canary.call_args.args[0]
+    assert some_param.some_int == "a"
+    assert isinstance(some_param.child, Child)
+    assert isinstance(some_param.children[0], Child)
+
+    assert client.post("/strict", json=body).status_code == 400
+
+
+def test_it_validates_a_sample_of_trusted_bodies(app, flastapi):
+    router = Router("test_router")
+
+    class SomeParam(BaseModel):
+        some_int: int
+
+    @router.post("/test", trusted=0.5)
+    def test(some_param: SomeParam):
+        return {}
+
+    flastapi.add_router(router)
+
+    client = app.test_client()
+    with mock.patch("flastapi.signature.mapper.random.random", return_value=0.7):
+        assert client.post("/test", json={"some_int": "a"}).status_code == 200
+    with mock.patch("flastapi.signature.mapper.random.random", return_value=0.2):
+        with mock.patch("flastapi.signature.mapper.logger") as logger:
+            assert client.post("/test", json={"some_int": "a"}).status_code == 400
+    logger.warning.assert_called_once()
+
+
+def test_it_reads_a_trusted_share_of_zero_as_trusting_everything(app, flastapi):
+    router = Router("test_router")
+
+    class SomeParam(BaseModel):
+        some_int: int
+
+    @router.post("/test", trusted=0.0)
+    def test(some_param: SomeParam):
+        return {}
+
+    flastapi.add_router(router)
+
+    assert app.test_client().post("/test", json={"some_int": "a"}).status_code == 200
+    with pytest.raises(ValueError):
+        router.post("/ambiguous", trusted=1)(test)
+
+
+def test_it_can_compile_routes_lazily(app, flastapi):
+    router = Router("test_router", lazy=True)
+
+    with mock.patch("flastapi.routing.parse_signature", wraps=parse_signature) as parse:
+        @router.get("/test/<int:some_id>")
+        def test(some_id: int, some_str: str):
+            return {"some_id": some_id, "some_str": some_str}
+
+        @router.get("/other")
+        def other():
+            return {}
+
+        flastapi.add_router(router)
+        parse.assert_not_called()
+
+        client = app.test_client()
+        response = client.get("/test/1?some_str=a")
+        assert response.json == {"some_id": 1, "some_str": "a"}
+        client.get("/test/2?some_str=b")
+        assert parse.call_count == 1
+
+        router.compile(flastapi)
+        assert parse.call_count == 2
+
+
+def test_it_extracts_path_parameters():
+    assert extract_path_parameters("/a/<b>/<int:c>/<path:d>") == ["b", "c", "d"]
+    assert extract_path_parameters('/<regex("[a-z]:x"):e>/<any(f, g):h>') == ["e", "h"]
+    assert extract_path_parameters("/static") == []
+
+
+def test_it_can_warm_up_and_freeze_before_forking(app, flastapi):
+    router = Router("test_router", lazy=True, parallel=True)
+
+    def get_page(page: int = 1):
+        return page
+
+    @router.get("/test")
+    def test(page: int = Depends(get_page)):
+        return {"page": page}
+
+    flastapi.add_router(router)
+    endpoint = router.endpoints[0]
+
+    with mock.patch("flastapi.gc") as gc:
+        flastapi.freeze()
+    gc.freeze.assert_called_once()
+    assert flastapi in endpoint.signature_mapper.plans
+    assert flastapi.executor is None
+
+    response = app.test_client().get("/test?page=2")
+    assert response.json == {"page": 2}
+    flastapi.close()
+
+
+def test_it_can_serve_an_openapi_document(app, flastapi):
+    router = Router("test_router")
+
+    class SomeParam(BaseModel):
+        some_int: int
+
+    class Filters(BaseModel):
+        name: str = ""
+
+    def get_user(token: str):
+        return token
+
+    @router.get("/test/<int:some_id>", response_model=SomeParam)
+    def test(
+        some_id: int,
+        page: int = Query(1, ge=1),
+        filters: Filters = Depends(Filters),
+        user=Depends(get_user),
+    ):
+        """Fetches a test."""
+        return {"some_int": some_id}
+
+    @router.post("/test")
+    def create(some_param: SomeParam, others: List[SomeParam]):
+        return {}
+
+    flastapi.add_router(router)
+    flastapi.enable_openapi(title="Test API")
+
+    client = app.test_client()
+    with mock.patch("flastapi.openapi.build_openapi", wraps=build_openapi) as build:
+        response = client.get("/openapi.json")
+        etag = response.headers["ETag"]
+        not_modified = client.get("/openapi.json", headers={"If-None-Match": etag})
+        assert client.get("/openapi.json").get_data() == response.get_data()
+    assert build.call_count == 1
+    assert not_modified.status_code == 304
+
+    document = response.json
+    assert document["info"] == {"title": "Test API", "version": "0.1.0"}
+    assert set(document["paths"]) == {"/test/{some_id}", "/test"}
+
+    get = document["paths"]["/test/{some_id}"]["get"]
+    assert get["summary"] == "Fetches a test."
+    assert get["parameters"] == [
+        {"name": "some_id", "in": "path", "required": True, "schema": {"type": "integer"}},
+        {"name": "page", "in": "query", "required": False,
+         "schema": {"type": "integer", "minimum": 1, "default": 1}},
+        {"name": "name", "in": "query", "required": False,
+         "schema": {"title": "Name", "default": "", "type": "string"}},
+        {"name": "token", "in": "query", "required": True, "schema": {"type": "string"}},
+    ]
+    assert get["responses"]["200"]["content"]["application/json"]["schema"] == {
+        "$ref": "#/components/schemas/SomeParam"
+    }
+
+    post = document["paths"]["/test"]["post"]
+    assert post["requestBody"]["content"]["application/json"]["schema"] == {
+        "type": "object",
+        "properties": {
+            "some_param": {"$ref": "#/components/schemas/SomeParam"},
+            "others": {"type": "array", "items": {"$ref": "#/components/schemas/SomeParam"}},
+        },
+        "required": ["some_param", "others"],
+    }
+    assert set(document["components"]["schemas"]) == {"SomeParam", "ValidationError"}
+
+
+def test_it_can_time_request_phases(app, flastapi):
+    router = Router("test_router")
+
+    class SomeParam(BaseModel):
+        name: str
+
+    def get_session():
+        yield "session"
+
+    @router.post("/test")
+    def test(some_param: SomeParam, page: int = 1, session: str = Depends(get_session)):
+        return {"name": some_param.name, "session": session}
+
+    flastapi.add_router(router)
+    observed = []
+    metrics = flastapi.enable_metrics(
+        "/metrics", callback=lambda endpoint, timings: observed.append((endpoint, timings))
+    )
+
+    client = app.test_client()
+    for _ in range(3):
+        response = client.post("/test?page=2", json={"name": "a"})
+        assert response.json == {"name": "a", "session": "session"}
+
+    assert len(observed) == 3
+    endpoint, timings = observed[0]
+    assert endpoint == "test_router.test"
+    assert set(timings) == {
+        "extract", "validate", "dependencies", "view", "serialize", "teardown"
+    }
+    assert all(elapsed >= 0 for elapsed in timings.values())
+
+    report = {entry["phase"]: entry for entry in metrics.report()}
+    assert report["view"]["count"] == 3
+    assert sum(report["view"]["buckets"].values()) == 3
+
+    exposition = client.get("/metrics").get_data(as_text=True)
+    assert "# TYPE flastapi_request_phase_seconds histogram" in exposition
+    labels = 'endpoint="test_router.test",phase="view"'
+    assert f'flastapi_request_phase_seconds_bucket{{{labels},le="+Inf"}} 3' in exposition
+    assert f"flastapi_request_phase_seconds_count{{{labels}}} 3" in exposition
+
+    metrics.reset()
+    assert metrics.report() == []
+    flastapi.metrics = None
+    client.post("/test", json={"name": "a"})
+    assert len(observed) == 3
+
+
+def test_it_times_parallel_dependencies(app, flastapi):
+    router = Router("test_router", parallel=True)
+
+    def get_a():
+        return "a"
+
+    def get_b(a: str = Depends(get_a)):
+        return a + "b"
+
+    @router.get("/test")
+    def test(page: int = 1, b: str = Depends(get_b)):
+        return {"b": b}
+
+    flastapi.add_router(router)
+    metrics = flastapi.enable_metrics()
+
+    assert app.test_client().get("/test").json == {"b": "ab"}
+    phases = {entry["phase"] for entry in metrics.report()}
+    assert phases == {"extract", "dependencies", "view", "serialize", "teardown"}
+
+
+def test_it_folds_metrics_of_exited_threads(app, flastapi):
+    metrics = flastapi.enable_metrics()
+    threads = [
+        threading.Thread(target=metrics.observe, args=("test", {"view": 0.001}))
+        for _ in range(50)
+    ]
+    for thread in threads:
+        thread.start()
+        thread.join()
+    metrics.observe("test", {"view": 0.001})
+
+    assert len(metrics.threads) == 1
+    (entry, ) = metrics.report()
+    assert entry["count"] == 51
+
+
+def test_it_profiles_requests_carrying_the_secret_header(app, flastapi):
+    router = Router("test_router")
+
+    def get_value():
+        return [str(i) for i in range(100)]
+
+    @router.get("/test")
+    def test(values: list = Depends(get_value)):
+        return {"values": values}
+
+    flastapi.add_router(router)
+    profiler = flastapi.profile_requests(secret="s3cret", memory=True, path="/_profiles")
+
+    client = app.test_client()
+    client.get("/test")
+    client.get("/test", headers={"X-Flastapi-Profile": "wrong"})
+    assert profiler.report() == {}
+
+    for _ in range(2):
+        assert client.get("/test", headers={"X-Flastapi-Profile": "s3cret"}).status_code == 200
+
+    report = profiler.report(top=50)["test_router.test"]
+    assert report["requests"] == 2
+    functions = [f["function"] for f in report["functions"]]
+    assert any(function.endswith("(get_value)") for function in functions)
+    assert report["peak_memory"] > 0
+    assert not tracemalloc.is_tracing()
+
+    assert client.get("/_profiles").status_code == 403
+    headers = {"X-Flastapi-Profile": "s3cret"}
+    served = client.get("/_profiles?top=5&sort=total", headers=headers).json
+    assert served["test_router.test"]["requests"] == 2
+    assert len(served["test_router.test"]["functions"]) == 5
+    assert client.get("/_profiles?sort=nope", headers=headers).status_code == 400
+
+    dump = client.get(
+        "/_profiles?endpoint=test_router.test&format=pstats", headers=headers
+    ).get_data()
+    assert marshal.loads(dump)
+    assert "get_value" in profiler.print_stats("test_router.test", top=50)
+
+
+def test_it_leaves_tracing_it_did_not_start_running(app, flastapi):
+    router = Router("test_router")
+
+    @router.get("/test")
+    def test():
+        return {}
+
+    flastapi.add_router(router)
+    flastapi.profile_requests(secret="s3cret", memory=True)
+
+    tracemalloc.start()
+    try:
+        app.test_client().get("/test", headers={"X-Flastapi-Profile": "s3cret"})
+        assert tracemalloc.is_tracing()
+    finally:
+        tracemalloc.stop()
+
+
+def test_it_profiles_a_sample_of_requests(app, flastapi):
+    router = Router("test_router")
+
+    @router.get("/test")
+    def test():
+        return {}
+
+    flastapi.add_router(router)
+    profiler = flastapi.profile_requests(sample_rate=0.5)
+
+    client = app.test_client()
+    with mock.patch("flastapi.profiling.random.random", side_effect=[0.2, 0.7, 0.1]):
+        for _ in range(3):
+            client.get("/test")
+    assert profiler.report()["test_router.test"]["requests"] == 2
+    assert "allocations" not in profiler.report()["test_router.test"]
+
+    with pytest.raises(ValueError):
+        flastapi.profile_requests(sample_rate=0.5, path="/_profiles")
+
+
+def test_it_closes_contexts_last_opened_first(app, flastapi):
+    router = Router("test_router")
+    closed = []
+
+    def get_engine():
+        yield "engine"
+        closed.append("engine")
+
+    def get_session(engine: str = Depends(get_engine)):
+        yield "session"
+        closed.append("session")
+
+    @router.get("/test")
+    def test(session: str = Depends(get_session)):
+        return {}
+
+    flastapi.add_router(router)
+    app.test_client().get("/test")
+    assert closed == ["session", "engine"]
+
+
+def test_it_throws_the_error_of_the_view_into_contexts(app, flastapi):
+    router = Router("test_router")
+    canary = mock.Mock()
+
+    def get_session():
+        try:
+            yield canary
+        except LookupError as e:
+            canary.rollback(e)
+            raise
+        else:
+            canary.commit()
+
+    @router.get("/test")
+    def test(session=Depends(get_session)):
+        raise LookupError("nope")
+
+    @router.get("/handled")
+    def handled(session=Depends(get_session)):
+        raise KeyError("nope")
+
+    @app.errorhandler(KeyError)
+    def handle_key_error(e):
+        return {"error": "missing"}, 404
+
+    flastapi.add_router(router)
+    client = app.test_client()
+
+    with pytest.raises(LookupError):
+        client.get("/test")
+    canary.rollback.assert_called_once()
+    canary.commit.assert_not_called()
+
+    assert client.get("/handled").status_code == 404
+    assert canary.rollback.call_count == 2
+    assert isinstance(canary.rollback.call_args[0][0], KeyError)
+
+
+def test_it_closes_contexts_of_failed_or_unsent_streams(app, flastapi):
+    router = Router("test_router")
+    canary = mock.Mock()
+
+    def get_cursor():
+        try:
+            yield "cursor"
+        except ValueError:
+            canary.rollback()
+            raise
+        finally:
+            canary.close()
+
+    @router.get("/failing", response_model=Iterator[dict])
+    def failing(cursor: str = Depends(get_cursor)):
+        yield {"a": 1}
+        raise ValueError("broken cursor")
+
+    @router.get("/unsent", response_model=Iterator[dict])
+    def unsent(cursor: str = Depends(get_cursor)):
+        yield {"a": 1}
+
+    flastapi.add_router(router)
+    client = app.test_client()
+
+    response = client.get("/failing", buffered=False)
+    canary.close.assert_not_called()
+    with pytest.raises(ValueError):
+        response.get_data()
+    canary.rollback.assert_called_once()
+    canary.close.assert_called_once()
+
+    response = client.get("/unsent", buffered=False)
+    canary.close.assert_called_once()
+    response.close()
+    assert canary.close.call_count == 2
+
+
+def test_it_closes_contexts_on_request_teardown(app, flastapi):
+    router = Router("test_router")
+    canary = mock.Mock()
+
+    class Interrupted(BaseException):
+        pass
+
+    def get_session():
+        try:
+            yield canary
+        finally:
+            canary.close()
+
+    @router.get("/test")
+    def test(session=Depends(get_session)):
+        raise Interrupted()
+
+    flastapi.add_router(router)
+    with pytest.raises(Interrupted):
+        app.test_client().get("/test")
+    canary.close.assert_called_once()
+
+
+def test_it_lends_out_pooled_resources(app, flastapi):
+    router = Router("test_router")
+    factory = mock.Mock(side_effect=lambda: mock.Mock())
+    clients = Pooled(factory, max_size=2)
+
+    @router.get("/test")
+    def test(client=clients, again=clients):
+        assert client is again
+        return {"client": id(client), "in_use": clients.stats()["in_use"]}
+
+    flastapi.add_router(router)
+    client = app.test_client()
+
+    responses = [client.get("/test").json for _ in range(3)]
+    assert {response["client"] for response in responses} == {responses[0]["client"]}
+    assert [response["in_use"] for response in responses] == [1, 1, 1]
+    assert factory.call_count == 1
+
+    stats = clients.stats()
+    assert stats["checkouts"] == 3
+    assert stats["created"] == 1
+    assert stats["idle"] == 1
+    assert stats["waits"] == 0
+    assert Pooled(factory, max_size=2) is clients
+
+    fake = mock.Mock()
+    flastapi.dependency_overrides[factory] = lambda: fake
+    assert client.get("/test").json["client"] == id(fake)
+    assert clients.stats()["checkouts"] == 3
+
+
+def test_it_times_out_when_the_pool_is_exhausted(app, flastapi):
+    router = Router("test_router")
+    clients = Pooled(object, max_size=1, timeout=0.01)
+
+    @router.get("/test")
+    def test(client=clients):
+        return {}
+
+    flastapi.add_router(router)
+    client = app.test_client()
+
+    resource = clients.pool.checkout()
+    assert client.get("/test").status_code == 503
+    clients.pool.checkin(resource)
+    assert client.get("/test").status_code == 200
+
+    stats = clients.stats()
+    assert stats["waits"] == 1
+    assert stats["timeouts"] == 1
+    assert stats["size"] == 1
+
+
+def test_it_replaces_unhealthy_pooled_resources():
+    disposed = []
+    pool = ResourcePool(
+        mock.Mock, max_size=1, health_check=lambda resource: resource.healthy,
+        dispose=disposed.append
+    )
+
+    first = pool.checkout()
+    first.healthy = False
+    pool.checkin(first)
+
+    second = pool.checkout()
+    assert second is not first
+    assert disposed == [first]
+    second.healthy = True
+    pool.checkin(second)
+    assert pool.checkout() is second
+
+    pool.checkin(second)
+    pool.close()
+    assert disposed == [first, second]
+    assert pool.stats()["size"] == 0
@@ -0,0 +1,36 @@
+import io
+import json
+from unittest import mock
+
+import pytest
+
+from flastapi.streaming import iter_json_array
+
+
+def test_it_parses_a_json_array_incrementally():
+    stream = io.BytesIO(b' [ {"a": [1, 2]}, "\xc3\xa9", 3 ,null] ')
+    items = list(iter_json_array(stream, chunk_size=3))
+    assert items == [{"a": [1, 2]}, "é", 3, None]
+    assert list(iter_json_array(io.BytesIO(b"[]"))) == []
+
+
+@pytest.mark.parametrize("body, message", [
+    (b'{"a": 1}', "Expected a JSON array"),
+    (b'[1 2]', "Expected ',' or ']' between array items"),
+    (b'[1, ', "Invalid JSON array item"),
+    (b'["abcdef"]', "Array item exceeds the maximum size of 4"),
+])
+def test_it_rejects_a_malformed_json_array(body, message):
+    with pytest.raises(ValueError, match=message):
+        list(iter_json_array(io.BytesIO(body), max_item_size=4, chunk_size=2))
+
+
+def test_it_decodes_a_large_item_a_logarithmic_number_of_times():
+    body = b'["' + b"a" * 1024 * 1024 + b'", 1]'
+    raw_decode = json.JSONDecoder.raw_decode
+    with mock.patch.object(
+        json.JSONDecoder, "raw_decode", autospec=True, side_effect=raw_decode
+    ) as decode:
+        items = list(iter_json_array(io.BytesIO(body), chunk_size=1024))
+    assert items == ["a" * 1024 * 1024, 1]
+    assert decode.call_count < 20